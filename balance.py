@@ -18,19 +18,83 @@
 
 import minqlx
 import requests
+import json
 import itertools
+import bisect
 import threading
 import random
 import time
+import struct
+import zlib
+import os
+
+from collections import OrderedDict
+
+try:
+    from .rating_api import RatingClient, FetchScheduler, LATENCY_BUCKETS
+    from .rating_api import PRIORITY_BALANCE, PRIORITY_TEAMS, PRIORITY_RATINGS, PRIORITY_PREFETCH, PRIORITY_NAMES
+except ImportError:
+    from rating_api import RatingClient, FetchScheduler, LATENCY_BUCKETS
+    from rating_api import PRIORITY_BALANCE, PRIORITY_TEAMS, PRIORITY_RATINGS, PRIORITY_PREFETCH, PRIORITY_NAMES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 RATING_KEY = "minqlx:players:{0}:ratings:{1}" # 0 == steam_id, 1 == short gametype.
-MAX_ATTEMPTS = 3
+CACHE_KEY = "minqlx:balance:cache:{0}:{1}" # 0 == steam_id, 1 == short gametype.
+LOCAL_GAMES_KEY = "minqlx:players:{0}:local_games:{1}" # 0 == steam_id, 1 == short gametype.
+MATCH_HISTORY_KEY = "minqlx:balance:matches:{}" # Short gametype.
+MAX_MATCH_HISTORY = 10000
+# Rating change per unit of surprise for locally computed ratings. Doubled while provisional.
+ELO_K_FACTOR = 16
+ELO_PROVISIONAL_GAMES = 10
+# Passes over the match history when recomputing local ratings from scratch.
+ELO_FIT_EPOCHS = 200
+# How many times a command fetches the ratings of players that joined while it was waiting before giving up.
+MAX_REFETCHES = 3
+# Time in seconds rating requests are collected for before they are fetched together.
+COALESCE_WINDOW = 0.05
+# Time in seconds ratings of connecting players are collected for before they are prefetched.
+PREFETCH_DELAY = 3
 CACHE_EXPIRE = 60*10 # 10 minutes TTL.
+# Expired ratings younger than this are still used while they're refreshed in the background.
+STALE_EXPIRE = 60*60
+# Seconds the API isn't asked again for players a fetch failed for. Commands that need them fail meanwhile.
+NEGATIVE_CACHE_EXPIRE = 60
+# Where "!balancestats export" writes the statistics, relative to fs_homepath.
+STATS_FILE = "balance_stats.json"
 DEFAULT_RATING = 1500
 UNTRACKED_RATING = 9999
 SUPPORTED_GAMETYPES = ("ad", "ca", "ctf", "dom", "ft", "tdm")
 # Externally supported game types. Used by !getrating for game types the API works with.
 EXT_SUPPORTED_GAMETYPES = ("ad", "ca", "ctf", "dom", "ft", "tdm", "duel", "ffa")
+# Players whose ratings are kept in memory. The least recently used are dropped first.
+MAX_CACHED_PLAYERS = 2048
+# Seconds player info from the API is kept. The number of players kept is set by qlx_balancePlayerInfoSize.
+PLAYER_INFO_EXPIRE = 3600
+# Lobbies up to this size are split optimally by !balance. 16v16 takes ~0.25s, 8v8 under a millisecond,
+# which is why !balance searches outside the game thread.
+EXACT_PARTITION_LIMIT = 32
+# Time in seconds bigger lobbies are allowed to spend improving a greedy split.
+PARTITION_TIME_BUDGET = 0.01
+# The maximum number of players from each team !teams can suggest to switch.
+MAX_SUGGESTION_SIZE = 3
+# Largest lobby for which "!teams full" evaluates every possible split.
+FULL_REPORT_LIMIT = 20
+# Permission level needed for "!teams full", since evaluating every split keeps a core busy for a while.
+FULL_REPORT_PERMISSION = 1
+# How many of the split matrices used by "!teams full" are kept around.
+SPLIT_CACHE_SIZE = 4
+# Cached ratings are saved to this file in fs_homepath, so that they survive restarts.
+SNAPSHOT_FILE = "balance_ratings.bin"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 60*5
+# Magic, version, number of records and CRC32 of the records.
+SNAPSHOT_HEADER = struct.Struct("<4sHII")
+# Steam ID, gametype, rating, games and time fetched.
+SNAPSHOT_RECORD = struct.Struct("<Q4sdid")
 
 
 class balance(minqlx.Plugin):
@@ -38,44 +102,117 @@ class balance(minqlx.Plugin):
         self.add_hook("round_countdown", self.handle_round_countdown)
         self.add_hook("round_start", self.handle_round_start)
         self.add_hook("vote_ended", self.handle_vote_ended)
+        self.add_hook("player_connect", self.handle_player_connect)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
+        self.add_hook("team_switch", self.handle_team_switch)
         self.add_hook("new_game", self.handle_new_game)
+        self.add_hook("game_end", self.handle_game_end)
+        self.add_hook("unload", self.handle_unload)
         self.add_command(("setrating", "setelo"), self.cmd_setrating, 3, usage="<id> <rating>")
         self.add_command(("getrating", "getelo", "elo"), self.cmd_getrating, usage="<id> [gametype]")
         self.add_command(("remrating", "remelo"), self.cmd_remrating, 3, usage="<id>")
+        self.add_command("recomputeratings", self.cmd_recomputeratings, 5, usage="[gametype]")
+        self.add_command("ratingqueue", self.cmd_ratingqueue, 3)
+        self.add_command("balancestats", self.cmd_balancestats, 3, usage="[export]")
         self.add_command("balance", self.cmd_balance, 1)
-        self.add_command(("teams", "teens"), self.cmd_teams)
+        self.add_command(("teams", "teens"), self.cmd_teams, usage="[full]")
         self.add_command("do", self.cmd_do, 1)
         self.add_command(("agree", "a"), self.cmd_agree, client_cmd_perm=0)
         self.add_command(("ratings", "elos", "selo"), self.cmd_ratings)
 
-        self.ratings_lock = threading.RLock()
-        # Keys: steam_id - Items: {"ffa": {"elo": 123, "games": 321, "local": False}, ...}
-        self.ratings = {}
+        self.ratings = RatingStore()
         # Keys: steam_id - Items: {"deactivated": true/false, "ratings": {...}, "allowRating": true/false, "privacy": "public/private/anonymous/untracked"}
-        self.player_info = {}
-        # Keys: request_id - Items: (players, callback, channel)
+        self.player_info = ExpiringCache(256, PLAYER_INFO_EXPIRE)
+        # Keys: request_id - Items: (players, callback, channel, args, time requested)
         self.requests = {}
         self.request_counter = itertools.count()
+        # Concurrent requests share fetches. Only one fetch per (steam_id, gametype) is done
+        # at a time, and keys queued up within COALESCE_WINDOW are fetched in a single batch.
+        self.fetch_lock = threading.Lock()
+        # Keys: (steam_id, gametype) - Items: set of request_ids waiting for it.
+        self.pending = {}
+        # Keys: request_id - Items: [set of (steam_id, gametype) left, status code]
+        self.waiting = {}
+        self.batch = set()
+        self.batch_priority = PRIORITY_PREFETCH
+        self.batch_timer = None
+        self.scheduler = FetchScheduler(self.fetch_ratings)
+        # Ratings of players that connect or join a team are fetched ahead of time, in batches
+        # collected over PREFETCH_DELAY, so that commands can usually skip the API entirely.
+        self.prefetch_batch = set()
+        self.prefetch_timer = None
+        # Keys that were prefetched and haven't been looked up since.
+        self.prefetched = set()
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        # Set once the plugin is unloaded, so that the timers stop rescheduling themselves.
+        self.unloaded = False
+        # Status code of the last failed fetch, which requests for players it failed for are failed with.
+        self.failed_status = requests.codes.service_unavailable
+        # The suggested switch as a tuple with the red players and the blue players.
         self.suggested_pair = None
-        self.suggested_agree = [False, False]
+        # Whether or not each suggested player agreed, in the order of red + blue players.
+        self.suggested_agree = []
         self.in_countdown = False
+        self.stats = BalanceStats()
+        self.client = RatingClient(None)
+        self.client.stats = self.stats
+        # Team strengths kept up to date as players move around. Built at round start if auto placement is on.
+        self.tracker = None
+        # Keys: (steam_id, gametype) - Items: rating loaded from the snapshot. None until needed.
+        self.snapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_timer = None
 
         self.set_cvar_once("qlx_balanceUseLocal", "1")
         self.set_cvar_once("qlx_balanceUrl", "qlstats.net")
         self.set_cvar_once("qlx_balanceAuto", "1")
         self.set_cvar_once("qlx_balanceMinimumSuggestionDiff", "25")
+        self.set_cvar_limit_once("qlx_balanceMaximumSuggestionSize", "3", "1", str(MAX_SUGGESTION_SIZE))
         self.set_cvar_once("qlx_balanceApi", "elo")
+        self.set_cvar_once("qlx_balanceRedisCache", "0")
+        self.set_cvar_once("qlx_balancePrefetch", "1")
+        self.set_cvar_once("qlx_balanceLocalIndex", "0")
+        self.set_cvar_once("qlx_balanceLocalElo", "0")
+        self.set_cvar_once("qlx_balancePlayerInfoSize", "256")
+        self.set_cvar_limit_once("qlx_balanceAutoPlace", "0", "0", "2")
 
         self.cache_cvars()
 
+        # Guards local_ratings and local_changes. The ratings cache has a lock of its own.
+        self.local_lock = threading.Lock()
+        # Keys: (steam_id, gametype) - Items: locally set rating. None unless loaded.
+        self.local_ratings = None
+        # Local ratings set or removed (None) while the index is loading, to be merged into it. None unless loading.
+        self.local_changes = None
+        if self.use_local and self.get_cvar("qlx_balanceLocalIndex", bool):
+            self.local_changes = {}
+            self.load_local_ratings()
+
+        self.schedule_snapshot()
+
     def cache_cvars(self):
         # Store some cvar values that are used in non-game threads
-        self.use_local = self.get_cvar("qlx_balanceUseLocal", bool)
-        self.api_url = "http://{}/{}/".format(self.get_cvar("qlx_balanceUrl"), self.get_cvar("qlx_balanceApi"))
+        # Locally computed ratings are stored like those set with !setrating.
+        self.use_local_elo = self.get_cvar("qlx_balanceLocalElo", bool)
+        self.use_local = self.get_cvar("qlx_balanceUseLocal", bool) or self.use_local_elo
+        self.use_redis_cache = self.get_cvar("qlx_balanceRedisCache", bool)
+        self.use_prefetch = self.get_cvar("qlx_balancePrefetch", bool)
+        # Any number of mirrors can be given, separated by commas or spaces.
+        self.api_urls = ["http://{}/{}/".format(url, self.get_cvar("qlx_balanceApi"))
+                         for url in self.get_cvar("qlx_balanceUrl").replace(",", " ").split()]
+        self.client.set_urls(self.api_urls)
+        # 0 to leave joining players alone, 1 to suggest the better team to them and 2 to put them there.
+        self.auto_place = self.get_cvar("qlx_balanceAutoPlace", int)
+        if not self.auto_place:
+            self.tracker = None
+        self.player_info.max_size = max(1, self.get_cvar("qlx_balancePlayerInfoSize", int))
+        home = self.get_cvar("fs_homepath")
+        self.snapshot_path = os.path.join(home, SNAPSHOT_FILE) if home else None
+        self.stats_path = os.path.join(home, STATS_FILE) if home else None
 
     def handle_round_countdown(self, *args, **kwargs):
-        if all(self.suggested_agree):
+        if self.suggested_pair and all(self.suggested_agree):
             # If we don't delay the switch a bit, the round countdown sound and
             # text disappears for some weird reason.
             @minqlx.next_frame
@@ -88,6 +225,15 @@ class balance(minqlx.Plugin):
     def handle_round_start(self, *args, **kwargs):
         self.in_countdown = False
 
+        # Resync the team strengths in case we missed something.
+        gt = self.game.type_short
+        if self.auto_place and gt in SUPPORTED_GAMETYPES:
+            self.tracker = TeamTracker()
+            teams = self.teams()
+            for team in ("red", "blue"):
+                for p in teams[team]:
+                    self.tracker.move(p.steam_id, team, self.cached_elo(p.steam_id, gt))
+
     def handle_vote_ended(self, votes, vote, args, passed):
         if passed == True and vote == "shuffle" and self.get_cvar("qlx_balanceAuto", bool):
             gt = self.game.type_short
@@ -102,19 +248,108 @@ class balance(minqlx.Plugin):
                     return
 
                 players = dict([(p.steam_id, gt) for p in players["red"] + players["blue"]])
-                self.add_request(players, self.callback_balance, minqlx.CHAT_CHANNEL)
+                self.add_request(players, self.callback_balance, minqlx.CHAT_CHANNEL, priority=PRIORITY_BALANCE)
             f()
 
+    def handle_player_connect(self, player):
+        gt = self.game.type_short
+        if self.use_prefetch and gt in EXT_SUPPORTED_GAMETYPES:
+            self.prefetch({player.steam_id: gt})
+
     def handle_player_disconnect(self, player, reason):
+        if self.tracker:
+            self.tracker.remove(player.steam_id)
         self.clean_player_data(player)
 
+    def handle_team_switch(self, player, old_team, new_team):
+        # The rating might have expired or been reset since they connected.
+        gt = self.game.type_short
+        if self.use_prefetch and new_team in ("red", "blue") and gt in EXT_SUPPORTED_GAMETYPES:
+            self.prefetch({player.steam_id: gt})
+
+        if not self.tracker or gt not in SUPPORTED_GAMETYPES:
+            return
+
+        # Only players we already have a rating for are placed, so we never wait for the API here.
+        elo = self.cached_elo(player.steam_id, gt)
+        if old_team == "spectator" and new_team in ("red", "blue") and elo is not None and self.tracker.complete():
+            team, improvement = self.tracker.placement(elo, new_team)
+            if team != new_team and improvement >= self.get_cvar("qlx_balanceMinimumSuggestionDiff", float):
+                self.place_player(player, team)
+
+        self.tracker.move(player.steam_id, new_team, elo)
+
+    def cached_elo(self, steam_id, gametype):
+        """A player's cached rating, even if it's expired, or None if we don't have one."""
+        rating = self.ratings.get(steam_id, gametype)
+        return rating.elo if rating and not rating.negative else None
+
+    @minqlx.next_frame
+    def place_player(self, player, team):
+        color = "^1" if team == "red" else "^4"
+        if self.auto_place == 1:
+            player.tell("Joining {}{}^7 instead would make the teams more even.".format(color, team))
+            return
+
+        try:
+            player.update()
+        except minqlx.NonexistentPlayerError:
+            return
+
+        if player.team in ("red", "blue") and player.team != team:
+            player.put(team)
+            self.msg("{}^7 was put on {}{}^7 to keep the teams even.".format(player.name, color, team))
+
+    def handle_game_end(self, data):
+        gt = self.game.type_short
+        if data["ABORTED"] or not self.use_local_elo or gt not in SUPPORTED_GAMETYPES:
+            return
+
+        teams = self.teams()
+        if not teams["red"] or not teams["blue"]:
+            return
+
+        if data["TSCORE0"] > data["TSCORE1"]:
+            score = 1
+        elif data["TSCORE0"] < data["TSCORE1"]:
+            score = 0
+        else:
+            score = 0.5
+
+        self.record_match(gt, [p.steam_id for p in teams["red"]], [p.steam_id for p in teams["blue"]], score)
+
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.unloaded = True
+            with self.fetch_lock:
+                for timer in (self.batch_timer, self.prefetch_timer):
+                    if timer:
+                        timer.cancel()
+                self.batch_timer = self.prefetch_timer = None
+            self.scheduler.close()
+            self.client.close()
+            if self.snapshot_timer:
+                self.snapshot_timer.cancel()
+            self.save_snapshot()
+
     def handle_new_game(self):
         self.cache_cvars()
 
         # reset ratings cache on start
         if self.game.state == "warmup":
-            with self.ratings_lock:
-                self.ratings = {}
+            self.save_snapshot()
+            self.ratings.clear()
+
+            gt = self.game.type_short
+            if self.use_prefetch and gt in EXT_SUPPORTED_GAMETYPES:
+                self.prefetch(dict([(p.steam_id, gt) for p in self.players()]))
+
+        if self.prefetch_hits + self.prefetch_misses:
+            self.logger.info("Rating prefetch hit ratio: {}% ({}/{})".format(
+                round(100 * self.prefetch_hit_ratio()), self.prefetch_hits, self.prefetch_hits + self.prefetch_misses))
+        if self.player_info.hits + self.player_info.misses + self.player_info.evictions:
+            self.logger.info("Player info cache: {} entries, {} hits, {} misses, {} evictions".format(
+                len(self.player_info), self.player_info.hits, self.player_info.misses, self.player_info.evictions))
 
     @minqlx.thread
     def clean_player_data(self, player):
@@ -123,145 +358,450 @@ class balance(minqlx.Plugin):
                 # there is a second client with same steam id
                 return
 
-        if player.steam_id in self.player_info:
-            del self.player_info[player.steam_id]
-
-        with self.ratings_lock:
-            if player.steam_id in self.ratings:
-                del self.ratings[player.steam_id]
-
-    @minqlx.thread
-    def fetch_ratings(self, players, request_id):
-        if not players:
-            return
+        self.player_info.pop(player.steam_id)
+        self.ratings.expire(player.steam_id)
 
+    def fetch_ratings(self, players):
+        keys = set(players.items())
+        status = -1
+        try:
+            status = self.request_ratings(players)
+        except Exception:
+            minqlx.log_exception(self)
+        finally:
+            self.finish_fetch(keys, status)
+
+    def request_ratings(self, players):
+        """Get the ratings of the players from the local database, the shared cache or the API,
+        in that order, and put them in the ratings cache. Returns the status code."""
         # We don't want to modify the actual dict, so we use a copy.
         players = players.copy()
 
         # Get local ratings if present in DB.
         if self.use_local:
-            for steam_id in players.copy():
-                gt = players[steam_id]
-                key = RATING_KEY.format(steam_id, gt)
-                if key in self.db:
-                    with self.ratings_lock:
-                        if steam_id in self.ratings:
-                            self.ratings[steam_id][gt] = {"games": -1, "elo": int(self.db[key]), "local": True, "time": -1}
-                        else:
-                            self.ratings[steam_id] = {gt: {"games": -1, "elo": int(self.db[key]), "local": True, "time": -1}}
-                    del players[steam_id]
+            local = self.get_local_ratings(players)
+            for steam_id, rating in local.items():
+                self.ratings.put(steam_id, players[steam_id], Rating(rating, local=True))
+                del players[steam_id]
 
+            self.stats.lookup("local", len(local), len(players))
             if not players:
-                self.handle_ratings_fetched(request_id, requests.codes.ok)
-                return
+                return requests.codes.ok
+
+        # We might have had them before a restart.
+        count = len(players)
+        self.load_snapshot_ratings(players)
+        self.stats.lookup("snapshot", count - len(players), len(players))
+        if not players:
+            return requests.codes.ok
+
+        # Another server sharing the database might have fetched them recently.
+        if self.use_redis_cache:
+            count = len(players)
+            self.load_shared_ratings(players)
+            self.stats.lookup("redis", count - len(players), len(players))
+            if not players:
+                return requests.codes.ok
 
-        attempts = 0
-        last_status = 0
+        fetching = list(players)
         untracked_sids = []
+        status, js = self.client.fetch(fetching, headers={"X-QuakeLive-Map": self.game.map})
+        if status != requests.codes.ok:
+            self.stats.count("http.failures")
+            self.failed_status = status
+            # Remember the failure for a little while for players we know nothing about, so that
+            # commands fail right away instead of all having to wait for an API that is having problems.
+            for sid in players:
+                self.ratings.put_missing(sid, players[sid], Rating(DEFAULT_RATING, time=time.time(), negative=True))
+            return status
+
+        # Fill our ratings cache with the ratings we just got.
+        for p in js["players"]:
+            sid = int(p["steamid"])
+            del p["steamid"]
+            t = time.time()
+
+            for gt in p:
+                if p[gt]["elo"] == 0 and p[gt]["games"] == 0:
+                    p[gt]["elo"] = DEFAULT_RATING
+                self.ratings.put(sid, gt, Rating(p[gt]["elo"], p[gt]["games"], t))
+
+            if sid in players and (players[sid] in p or players[sid] in SUPPORTED_GAMETYPES):
+                if players[sid] not in p:
+                    # The API knows the player, just not in the game type we wanted.
+                    self.ratings.put(sid, players[sid], Rating(DEFAULT_RATING, time=t))
+                del players[sid]
+
+        # If the API didn't return all the players, we set them to the default rating.
+        self.stats.lookup("http", len(fetching) - len(players), len(players))
+        for sid in players:
+            self.ratings.put(sid, players[sid], Rating(DEFAULT_RATING, time=time.time()))
+
+        # Setting ratings for untracked players.
+        if "untracked" in js:
+            untracked_sids = list(map( lambda sid: int(sid), js["untracked"]))
+
+        self.stats.count("untracked", len(untracked_sids))
+        for gt in SUPPORTED_GAMETYPES:
+            for sid in untracked_sids:
+                self.ratings.put(sid, gt, Rating(UNTRACKED_RATING, time=time.time()))
+
+        # Saving player info
+        try:
+            for player, data in js["playerinfo"].items():
+                self.player_info.put(int(player), data)
+        except KeyError:
+            pass
+
+        if self.use_redis_cache:
+            self.store_shared_ratings(fetching + untracked_sids)
+
+        return requests.codes.ok
+
+    def get_local_ratings(self, players):
+        """Get the locally set ratings of the players, if any. Uses the local rating index
+        if it's loaded, and otherwise looks them all up with a single MGET."""
+        sids = list(players)
+        if not sids:
+            return {}
+        elif self.local_ratings is not None:
+            ratings = [self.local_ratings.get((sid, players[sid])) for sid in sids]
+        else:
+            ratings = self.db.mget([RATING_KEY.format(sid, players[sid]) for sid in sids])
 
-        while attempts < MAX_ATTEMPTS:
-            attempts += 1
-            url = self.api_url + "+".join([str(sid) for sid in players])
-            res = requests.get(url, headers={"X-QuakeLive-Map": self.game.map})
-            last_status = res.status_code
-            if res.status_code != requests.codes.ok:
-                continue
+        return dict((sid, int(rating)) for sid, rating in zip(sids, ratings) if rating is not None)
 
-            js = res.json()
-            if "players" not in js:
-                last_status = -1
-                continue
+    @minqlx.thread
+    def load_local_ratings(self):
+        """Load every locally set rating into memory so that looking them up costs nothing."""
+        index = {}
+        keys = list(self.db.scan_iter(match=RATING_KEY.format("*", "*"), count=1000))
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i:i + 1000]
+            for key, rating in zip(chunk, self.db.mget(chunk)):
+                sid, gt = key.split(":")[2::2]
+                if rating is not None and sid.isdigit():
+                    index[(int(sid), gt)] = int(rating)
+
+        # Ratings set while we were reading might not have made it into what we read.
+        with self.local_lock:
+            for key, rating in self.local_changes.items():
+                if rating is None:
+                    index.pop(key, None)
+                else:
+                    index[key] = rating
+            self.local_ratings = index
+            self.local_changes = None
+
+    def update_local_index(self, steam_id, gametype, rating):
+        """Set a rating in the local rating index, or remove it if *rating* is None. If the index
+        is still loading, the change is merged into it once it's loaded."""
+        key = (steam_id, gametype)
+        with self.local_lock:
+            if self.local_ratings is not None:
+                if rating is None:
+                    self.local_ratings.pop(key, None)
+                else:
+                    self.local_ratings[key] = rating
+            elif self.local_changes is not None:
+                self.local_changes[key] = rating
 
-            # Fill our ratings dict with the ratings we just got.
-            for p in js["players"]:
-                sid = int(p["steamid"])
-                del p["steamid"]
-                t = time.time()
-
-                with self.ratings_lock:
-                    if sid not in self.ratings:
-                        self.ratings[sid] = {}
-
-                    for gt in p:
-                        p[gt]["time"] = t
-                        p[gt]["local"] = False
-                        self.ratings[sid][gt] = p[gt]
-                        if self.ratings[sid][gt]["elo"] == 0 and self.ratings[sid][gt]["games"] == 0:
-                            self.ratings[sid][gt]["elo"] = DEFAULT_RATING
-
-                        if sid in players and gt == players[sid]:
-                            # The API gave us the game type we wanted, so we remove it.
-                            del players[sid]
-
-                    # Fill the rest of the game types the API didn't return but supports.
-                    for gt in SUPPORTED_GAMETYPES:
-                        if gt not in self.ratings[sid]:
-                            self.ratings[sid][gt] = {"games": -1, "elo": DEFAULT_RATING, "local": False, "time": time.time()}
-
-            # If the API didn't return all the players, we set them to the default rating.
-            for sid in players:
-                with self.ratings_lock:
-                    if sid not in self.ratings:
-                        self.ratings[sid] = {}
-                    self.ratings[sid][players[sid]] = {"games": -1, "elo": DEFAULT_RATING, "local": False, "time": time.time()}
-
-            # Setting ratings for untracked players.
-            if "untracked" in js:
-                untracked_sids = list(map( lambda sid: int(sid), js["untracked"]))
-
-            for gt in SUPPORTED_GAMETYPES:
-                for sid in untracked_sids:
-                  with self.ratings_lock:
-                      if sid not in self.ratings:
-                          self.ratings[sid] = {}
-                      self.ratings[sid][gt] = {"games": -1, "elo": UNTRACKED_RATING, "local": False, "time": time.time()}
-
-            # Saving player info
-            try:
-                for player, data in js["playerinfo"].items():
-                    sid = int(player)
-                    self.player_info[sid] = js["playerinfo"][player]
-                    self.player_info[sid]["time"] = time.time()
-            except KeyError:
-                pass
+    @minqlx.thread
+    def record_match(self, gametype, red, blue, score):
+        """Update the local ratings of the players in a finished game and add it to the match history.
+        *score* is 1 if red won, 0 if blue won and 0.5 for a draw."""
+        sids = red + blue
+        ratings = self.get_local_ratings(dict((sid, gametype) for sid in sids))
+        games = self.db.mget([LOCAL_GAMES_KEY.format(sid, gametype) for sid in sids])
+        games = dict((sid, int(g) if g else 0) for sid, g in zip(sids, games))
+
+        # Players without a local rating start out with whatever rating we have cached for them.
+        for sid in sids:
+            if sid not in ratings:
+                cached = self.cached_elo(sid, gametype)
+                ratings[sid] = cached if cached is not None and cached != UNTRACKED_RATING else DEFAULT_RATING
+
+        ratings = update_elo(ratings, games, red, blue, score)
+
+        db = self.db.pipeline()
+        for sid in sids:
+            db.set(RATING_KEY.format(sid, gametype), ratings[sid])
+            db.incr(LOCAL_GAMES_KEY.format(sid, gametype))
+        db.rpush(MATCH_HISTORY_KEY.format(gametype), json.dumps({"red": red, "blue": blue, "score": score}))
+        db.ltrim(MATCH_HISTORY_KEY.format(gametype), -MAX_MATCH_HISTORY, -1)
+        db.execute()
+        self.set_local_ratings(gametype, ratings)
+
+    def set_local_ratings(self, gametype, ratings):
+        """Put newly computed local ratings in the ratings cache and the local rating index."""
+        for sid, rating in ratings.items():
+            self.update_local_index(sid, gametype, rating)
+            self.ratings.put(sid, gametype, Rating(rating, local=True))
+
+    def load_snapshot_ratings(self, players):
+        """Fill the ratings cache with unexpired ratings from the snapshot and remove the
+        players that were found from the dict passed. The snapshot is read on first use."""
+        with self.snapshot_lock:
+            if self.snapshot is None:
+                if not self.snapshot_path:
+                    return
+                try:
+                    self.snapshot = read_snapshot(self.snapshot_path)
+                except (OSError, ValueError, struct.error):
+                    self.snapshot = {}
+
+            now = time.time()
+            for sid in list(players):
+                rating = self.snapshot.pop((sid, players[sid]), None)
+                if rating and now < rating.time + CACHE_EXPIRE:
+                    self.ratings.put(sid, players[sid], rating)
+                    del players[sid]
+
+    def save_snapshot(self):
+        """Write every unexpired rating we got from the API to the snapshot file."""
+        if not self.snapshot_path:
+            return
 
-            break
+        now = time.time()
+        entries = {}
+        with self.snapshot_lock:
+            for key, rating in (self.snapshot or {}).items():
+                if now < rating.time + CACHE_EXPIRE:
+                    entries[key] = rating
+        for sid, gt, rating in self.ratings.items():
+            if not rating.local and not rating.negative and now < rating.time + CACHE_EXPIRE:
+                entries[(sid, gt)] = rating
+
+        self.write_snapshot(entries)
+
+    @minqlx.thread
+    def write_snapshot(self, entries):
+        try:
+            write_snapshot(self.snapshot_path, entries)
+        except OSError:
+            minqlx.log_exception(self)
 
-        if attempts == MAX_ATTEMPTS:
-            self.handle_ratings_fetched(request_id, last_status)
+    def schedule_snapshot(self):
+        if self.unloaded:
             return
+        self.snapshot_timer = threading.Timer(SNAPSHOT_INTERVAL, self.periodic_snapshot)
+        self.snapshot_timer.daemon = True
+        self.snapshot_timer.start()
+        # In case we were unloaded after the check above, but before handle_unload could see the new timer.
+        if self.unloaded:
+            self.snapshot_timer.cancel()
+
+    def periodic_snapshot(self):
+        if self.unloaded:
+            return
+        self.save_snapshot()
+        self.schedule_snapshot()
+
+    def load_shared_ratings(self, players):
+        """Fill the ratings cache with unexpired ratings other servers have stored in the
+        database and remove the players that were found from the dict passed."""
+        sids = list(players)
+        values = self.db.mget([CACHE_KEY.format(sid, players[sid]) for sid in sids])
+        for sid, value in zip(sids, values):
+            if value is None:
+                continue
 
-        self.handle_ratings_fetched(request_id, requests.codes.ok)
+            rating = json.loads(value)
+            self.ratings.put(sid, players[sid], Rating(rating["elo"], rating["games"], rating["time"]))
+            del players[sid]
+
+    def store_shared_ratings(self, sids):
+        """Store the cached ratings of the given players in the database so that other
+        servers can use them, expiring them at the same time they expire here."""
+        now = time.time()
+        db = self.db.pipeline()
+        for sid in set(sids):
+            for gt, rating in self.ratings.gametypes(sid).items():
+                ttl = int(rating.time + CACHE_EXPIRE - now)
+                if rating.local or rating.negative or ttl <= 0:
+                    continue
+                key = CACHE_KEY.format(sid, gt)
+                db.set(key, json.dumps({"elo": rating.elo, "games": rating.games, "time": rating.time}))
+                db.expire(key, ttl)
+        db.execute()
 
     @minqlx.next_frame
     def handle_ratings_fetched(self, request_id, status_code):
-        players, callback, channel, args = self.requests[request_id]
+        players, callback, channel, args, requested = self.requests[request_id]
         del self.requests[request_id]
-        if status_code != requests.codes.ok:
+        self.stats.observe("callback.latency", time.monotonic() - requested, LATENCY_BUCKETS)
+        if status_code == requests.codes.ok:
+            callback(players, channel, *args)
+        elif all(self.cached_elo(sid, gt) is not None for sid, gt in players.items()):
+            # Every player has a rating we got before, even if it's expired.
+            channel.reply("WARNING {}: Failed to fetch ratings. Using old ratings.".format(status_code))
+            callback(players, channel, *args)
+        else:
             # TODO: Put a couple of known errors here for more detailed feedback.
             channel.reply("ERROR {}: Failed to fetch ratings.".format(status_code))
-        else:
-            callback(players, channel, *args)
 
-    def add_request(self, players, callback, channel, *args):
+    def add_request(self, players, callback, channel, *args, priority=PRIORITY_RATINGS):
         req = next(self.request_counter)
-        self.requests[req] = players.copy(), callback, channel, args
-
-        # Only start a new thread if we need to make an API request.
-        if self.remove_cached(players):
-            self.fetch_ratings(players, req)
+        self.requests[req] = players.copy(), callback, channel, args, time.monotonic()
+
+        with self.fetch_lock:
+            wanted = set(players.items())
+            stale = set()
+            failed = set()
+            keys = set(self.remove_cached(players, stale, failed).items())
+            self.stats.lookup("memory", len(wanted) - len(keys) - len(failed), len(keys) + len(failed))
+            self.prefetch_hits += len(wanted & self.prefetched - keys - failed)
+            self.prefetch_misses += len(keys) + len(failed)
+            self.prefetched -= wanted
+            # Players a fetch just failed for aren't fetched again yet, so the request fails unless
+            # the players have a rating from before. The other players are still fetched for next time.
+            status = self.failed_status if failed else requests.codes.ok
+
+            # Only fetch ratings if some of them aren't cached.
+            if keys:
+                self.waiting[req] = [keys, status]
+            for key in keys:
+                if key in self.prefetch_batch:
+                    # Someone needs it now, so it can't wait for the prefetch.
+                    self.prefetch_batch.discard(key)
+                    self.pending[key].add(req)
+                    self.batch.add(key)
+                elif key in self.pending:
+                    # Someone is already getting this rating, so we just wait for it too.
+                    # If that fetch hasn't started yet, it shouldn't wait longer than we would.
+                    self.pending[key].add(req)
+                    if key not in self.batch:
+                        self.scheduler.promote(key, priority)
+                else:
+                    self.pending[key] = {req}
+                    self.batch.add(key)
+            if keys:
+                self.batch_priority = min(self.batch_priority, priority)
+
+            # Expired ratings are good enough for now, but we want fresh ones for next time.
+            for key in stale:
+                if key not in self.pending:
+                    self.pending[key] = set()
+                    self.batch.add(key)
+                elif key in self.prefetch_batch:
+                    self.prefetch_batch.discard(key)
+                    self.batch.add(key)
+
+            if self.batch and not self.batch_timer:
+                self.batch_timer = threading.Timer(COALESCE_WINDOW, self.flush_batch)
+                self.batch_timer.daemon = True
+                self.batch_timer.start()
+
+        if not keys:
+            # Nothing needs fetching, so we tell it to go ahead and call the callbacks.
+            self.handle_ratings_fetched(req, status)
+
+    def fetch_missing(self, players, current, callback, channel, refetches, *args, priority=PRIORITY_RATINGS):
+        """Fetch the ratings of players in *current* that aren't in *players*, and call *callback*
+        with all of them and *args* once we have them. Returns False if there was nothing to fetch."""
+        gt = self.game.type_short
+        missing = dict([(p.steam_id, gt) for p in current if p.steam_id not in players])
+        if not missing:
+            return False
+        elif refetches >= MAX_REFETCHES:
+            channel.reply("Players keep joining while fetching ratings. Try again in a moment.")
         else:
-            # All players were cached, so we tell it to go ahead and call the callbacks.
-            self.handle_ratings_fetched(req, requests.codes.ok)
-
-    def remove_cached(self, players):
-        with self.ratings_lock:
-            for sid in players.copy():
-                gt = players[sid]
-                if sid in self.ratings and gt in self.ratings[sid]:
-                    t = self.ratings[sid][gt]["time"]
-                    if t == -1 or time.time() < t + CACHE_EXPIRE:
-                        del players[sid]
+            self.add_request(missing, self.callback_missing, channel, players, callback, refetches + 1, *args,
+                             priority=priority)
+        return True
+
+    def callback_missing(self, missing, channel, players, callback, refetches, *args):
+        players = players.copy()
+        players.update(missing)
+        callback(players, channel, *args, refetches=refetches)
+
+    def prefetch(self, players):
+        """Queue up ratings that are likely to be needed soon. They are fetched together
+        with any other prefetches after PREFETCH_DELAY."""
+        players = self.remove_cached(players.copy())
+        with self.fetch_lock:
+            for key in players.items():
+                if key not in self.pending:
+                    self.pending[key] = set()
+                    self.prefetch_batch.add(key)
+
+            if self.prefetch_batch and not self.prefetch_timer:
+                self.prefetch_timer = threading.Timer(PREFETCH_DELAY, self.flush_batch, (True,))
+                self.prefetch_timer.daemon = True
+                self.prefetch_timer.start()
+
+    def prefetch_hit_ratio(self):
+        """The fraction of ratings requested by commands that were found cached thanks to a prefetch."""
+        total = self.prefetch_hits + self.prefetch_misses
+        return self.prefetch_hits / total if total else 0
+
+    def flush_batch(self, prefetch=False):
+        """Start fetching every rating that was queued up during the coalescing window,
+        or the prefetch delay if *prefetch* is true."""
+        with self.fetch_lock:
+            if prefetch:
+                batch = self.prefetch_batch
+                self.prefetch_batch = set()
+                self.prefetch_timer = None
+                self.prefetched |= batch
+                priority = PRIORITY_PREFETCH
+            else:
+                batch = self.batch
+                self.batch = set()
+                self.batch_timer = None
+                priority = self.batch_priority
+                self.batch_priority = PRIORITY_PREFETCH
+
+        # A player can only be in a fetch once, so we need another fetch in
+        # the rare case that someone wants the ratings of multiple game types.
+        fetches = []
+        for sid, gt in batch:
+            for players in fetches:
+                if sid not in players:
+                    players[sid] = gt
+                    break
+            else:
+                fetches.append({sid: gt})
+
+        for players in fetches:
+            self.scheduler.submit(players, priority)
+
+    def finish_fetch(self, keys, status_code):
+        """Let every request waiting on the given ratings know they are in, and go ahead
+        with the ones that are not waiting on anything else."""
+        with self.fetch_lock:
+            for key in keys:
+                for req in self.pending.pop(key, ()):
+                    waiting = self.waiting[req]
+                    waiting[0].discard(key)
+                    if status_code != requests.codes.ok:
+                        waiting[1] = status_code
+                    if not waiting[0]:
+                        del self.waiting[req]
+                        self.handle_ratings_fetched(req, waiting[1])
+
+    def remove_cached(self, players, stale=None, failed=None):
+        """Remove players with cached ratings from the dict and return it. If *stale* is a set,
+        ratings that expired less than STALE_EXPIRE ago also count as cached and their keys
+        are added to it so that they can be refreshed. Players a fetch failed for less than
+        NEGATIVE_CACHE_EXPIRE ago are removed too, since they shouldn't be fetched again yet,
+        but they don't have a rating. If *failed* is a set, their keys are added to it."""
+        now = time.time()
+        for sid in players.copy():
+            gt = players[sid]
+            rating = self.ratings.get(sid, gt)
+            if not rating:
+                continue
+            elif rating.negative:
+                if now < rating.time + NEGATIVE_CACHE_EXPIRE:
+                    if failed is not None:
+                        failed.add((sid, gt))
+                    del players[sid]
+            elif rating.time == -1 or now < rating.time + CACHE_EXPIRE:
+                del players[sid]
+            elif stale is not None and now < rating.time + STALE_EXPIRE:
+                stale.add((sid, gt))
+                del players[sid]
 
         return players
 
@@ -305,7 +845,11 @@ class balance(minqlx.Plugin):
         else:
             name = sid
 
-        channel.reply("{} has a rating of ^6{}^7 in {}.".format(name, self.ratings[sid][gametype]["elo"], gametype.upper()))
+        channel.reply("{} has a rating of ^6{}^7 in {}.".format(name, self.ratings.get(sid, gametype).elo, gametype.upper()))
+        # Let them know if the rating service doesn't show everything about the player.
+        info = self.player_info.get(sid)
+        if info and info.get("privacy", "public") != "public":
+            channel.reply("Their rating profile is ^6{}^7.".format(info["privacy"]))
 
     def cmd_setrating(self, player, msg, channel):
         if len(msg) < 3:
@@ -339,11 +883,9 @@ class balance(minqlx.Plugin):
         self.db[RATING_KEY.format(sid, gt)] = rating
 
         # If we have the player cached, set the rating.
-        with self.ratings_lock:
-            if sid in self.ratings and gt in self.ratings[sid]:
-                self.ratings[sid][gt]["elo"] = rating
-                self.ratings[sid][gt]["local"] = True
-                self.ratings[sid][gt]["time"] = -1
+        self.update_local_index(sid, gt, rating)
+        if self.ratings.get(sid, gt):
+            self.ratings.put(sid, gt, Rating(rating, local=True))
 
         channel.reply("{}'s {} rating has been set to ^6{}^7.".format(name, gt.upper(), rating))
 
@@ -373,12 +915,43 @@ class balance(minqlx.Plugin):
         del self.db[RATING_KEY.format(sid, gt)]
 
         # If we have the player cached, remove the game type.
-        with self.ratings_lock:
-            if sid in self.ratings and gt in self.ratings[sid]:
-                del self.ratings[sid][gt]
+        self.update_local_index(sid, gt, None)
+        self.ratings.expire(sid, gt)
 
         channel.reply("{}'s locally set {} rating has been deleted.".format(name, gt.upper()))
 
+    def cmd_recomputeratings(self, player, msg, channel):
+        """Recomputes all local ratings of a game type from the stored match history."""
+        if len(msg) > 1:
+            gt = msg[1].lower()
+        else:
+            gt = self.game.type_short
+
+        if gt not in SUPPORTED_GAMETYPES:
+            player.tell("Invalid gametype. Supported gametypes: {}".format(", ".join(SUPPORTED_GAMETYPES)))
+            return minqlx.RET_STOP_ALL
+
+        channel.reply("Recomputing local {} ratings...".format(gt.upper()))
+        self.recompute_ratings(gt, channel)
+
+    @minqlx.thread
+    def recompute_ratings(self, gametype, channel):
+        matches = [json.loads(m) for m in self.db.lrange(MATCH_HISTORY_KEY.format(gametype), 0, -1)]
+        matches = [(m["red"], m["blue"], m["score"]) for m in matches]
+        ratings = fit_ratings(matches)
+
+        db = self.db.pipeline()
+        for sid, rating in ratings.items():
+            db.set(RATING_KEY.format(sid, gametype), rating)
+        db.execute()
+        self.set_local_ratings(gametype, ratings)
+
+        @minqlx.next_frame
+        def reply():
+            channel.reply("Recomputed local {} ratings of ^6{}^7 players from ^6{}^7 games."
+                .format(gametype.upper(), len(ratings), len(matches)))
+        reply()
+
     def cmd_balance(self, player, msg, channel):
         gt = self.game.type_short
         if gt not in SUPPORTED_GAMETYPES:
@@ -391,19 +964,15 @@ class balance(minqlx.Plugin):
             return minqlx.RET_STOP_ALL
 
         players = dict([(p.steam_id, gt) for p in teams["red"] + teams["blue"]])
-        self.add_request(players, self.callback_balance, minqlx.CHAT_CHANNEL)
+        self.add_request(players, self.callback_balance, minqlx.CHAT_CHANNEL, priority=PRIORITY_BALANCE)
 
-    def callback_balance(self, players, channel):
+    def callback_balance(self, players, channel, refetches=0):
         # We check if people joined while we were requesting ratings and get them if someone did.
         teams = self.teams()
-        current = teams["red"] + teams["blue"]
         gt = self.game.type_short
-
-        for p in current:
-            if p.steam_id not in players:
-                d = dict([(p.steam_id, gt) for p in current])
-                self.add_request(d, self.callback_balance, channel)
-                return
+        if self.fetch_missing(players, teams["red"] + teams["blue"], self.callback_balance, channel, refetches,
+                              priority=PRIORITY_BALANCE):
+            return
 
         # Start out by evening out the number of players on each team.
         diff = len(teams["red"]) - len(teams["blue"])
@@ -419,35 +988,56 @@ class balance(minqlx.Plugin):
                     p.put("red")
                     teams["red"].append(p)
 
-        # Start shuffling by looping through our suggestion function until
-        # there are no more switches that can be done to improve teams.
-        switch = self.suggest_switch(teams, gt)
-        if switch:
-            while switch:
-                p1 = switch[0][0]
-                p2 = switch[0][1]
-                self.switch(p1, p2)
-                teams["blue"].append(p1)
-                teams["red"].append(p2)
-                teams["blue"].remove(p2)
-                teams["red"].remove(p1)
-                switch = self.suggest_switch(teams, gt)
-            avg_red = self.team_average(teams["red"], gt)
-            avg_blue = self.team_average(teams["blue"], gt)
-            diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
-            if round(avg_red) > round(avg_blue):
-                self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
-                    .format(round(avg_red), round(avg_blue), diff_rounded))
-            elif round(avg_red) < round(avg_blue):
-                self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
-                    .format(round(avg_red), round(avg_blue), diff_rounded))
-            else:
-                self.msg("^1{} ^7vs ^4{}^7 - Holy shit!"
-                    .format(round(avg_red), round(avg_blue)))
-        else:
-            channel.reply("Teams are good! Nothing to balance.")
+        self.balance_teams(self.team_model(teams, gt), channel)
         return True
 
+    @minqlx.thread
+    def balance_teams(self, model, channel):
+        """Find the best possible split and move as few players as we can to get there. Finding
+        it takes up to a few hundred milliseconds in big lobbies, so only the switches are done
+        on the game thread."""
+        players = model.players("red") + model.players("blue")
+        ratings = model.ratings("red") + model.ratings("blue")
+        size = model.count["red"]
+        red, diff = best_partition(ratings, size)
+        if size == model.count["blue"]:
+            # Same sized teams can just as well be flipped, so pick whatever needs fewer moves.
+            blue = set(range(len(players))) - red
+            if sum(1 for i in blue if i >= size) < sum(1 for i in red if i >= size):
+                red = blue
+
+        @minqlx.next_frame
+        def apply():
+            teams = self.teams()
+            if (set(p.steam_id for p in teams["red"]) != set(p.steam_id for p in model.players("red")) or
+                    set(p.steam_id for p in teams["blue"]) != set(p.steam_id for p in model.players("blue"))):
+                channel.reply("Teams changed while balancing. Try again.")
+                return
+
+            if model.difference() - diff > 1e-9:
+                to_blue = [players[i] for i in range(size) if i not in red]
+                to_red = [players[i] for i in range(size, len(players)) if i in red]
+                for p1, p2 in zip(to_blue, to_red):
+                    self.switch(p1, p2)
+                    model.switch(p1, p2)
+
+                avg_red = model.average("red")
+                avg_blue = model.average("blue")
+                diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
+                if round(avg_red) > round(avg_blue):
+                    self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
+                        .format(round(avg_red), round(avg_blue), diff_rounded))
+                elif round(avg_red) < round(avg_blue):
+                    self.msg("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^4{}"
+                        .format(round(avg_red), round(avg_blue), diff_rounded))
+                else:
+                    self.msg("^1{} ^7vs ^4{}^7 - Holy shit!"
+                        .format(round(avg_red), round(avg_blue)))
+            else:
+                channel.reply("Teams are good! Nothing to balance.")
+
+        apply()
+
     def cmd_teams(self, player, msg, channel):
         gt = self.game.type_short
         if gt not in SUPPORTED_GAMETYPES:
@@ -459,24 +1049,28 @@ class balance(minqlx.Plugin):
             player.tell("Both teams should have the same number of players.")
             return minqlx.RET_STOP_ALL
 
+        full = len(msg) > 1 and msg[1].lower() == "full"
+        if full and not self.db.has_permission(player, FULL_REPORT_PERMISSION):
+            player.tell("You need permission level {} to use ^6!teams full^7.".format(FULL_REPORT_PERMISSION))
+            return minqlx.RET_STOP_ALL
+
         teams = dict([(p.steam_id, gt) for p in teams["red"] + teams["blue"]])
-        self.add_request(teams, self.callback_teams, channel)
+        self.add_request(teams, self.callback_teams, channel, full, priority=PRIORITY_TEAMS)
 
-    def callback_teams(self, players, channel):
+    def callback_teams(self, players, channel, full=False, refetches=0):
         # We check if people joined while we were requesting ratings and get them if someone did.
         teams = self.teams()
-        current = teams["red"] + teams["blue"]
         gt = self.game.type_short
+        if self.fetch_missing(players, teams["red"] + teams["blue"], self.callback_teams, channel, refetches, full,
+                              priority=PRIORITY_TEAMS):
+            return
 
-        for p in current:
-            if p.steam_id not in players:
-                d = dict([(p.steam_id, gt) for p in current])
-                self.add_request(d, self.callback_teams, channel)
-                return
-
-        avg_red = self.team_average(teams["red"], gt)
-        avg_blue = self.team_average(teams["blue"], gt)
-        switch = self.suggest_switch(teams, gt)
+        model = self.team_model(teams, gt)
+        avg_red = model.average("red")
+        avg_blue = model.average("blue")
+        minimum_suggestion_diff = self.get_cvar("qlx_balanceMinimumSuggestionDiff", float)
+        switch = self.suggest_switch(model, gt, self.get_cvar("qlx_balanceMaximumSuggestionSize", int),
+                                     minimum_suggestion_diff)
         diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
         if round(avg_red) > round(avg_blue):
             channel.reply("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
@@ -488,13 +1082,16 @@ class balance(minqlx.Plugin):
             channel.reply("^1{} ^7vs ^4{}^7 - Holy shit!"
                 .format(round(avg_red), round(avg_blue)))
 
-        minimum_suggestion_diff = self.get_cvar("qlx_balanceMinimumSuggestionDiff", float)
+        if full:
+            self.report_teams(model, channel)
+
         if switch and switch[1] >= minimum_suggestion_diff:
+            red, blue = switch[0]
             channel.reply("SUGGESTION: switch ^6{}^7 with ^6{}^7. Mentioned players can type !a to agree."
-                .format(switch[0][0].clean_name, switch[0][1].clean_name))
-            if not self.suggested_pair or self.suggested_pair[0] != switch[0][0] or self.suggested_pair[1] != switch[0][1]:
-                self.suggested_pair = (switch[0][0], switch[0][1])
-                self.suggested_agree = [False, False]
+                .format("^7 and ^6".join(p.clean_name for p in red), "^7 and ^6".join(p.clean_name for p in blue)))
+            if self.suggested_pair != (red, blue):
+                self.suggested_pair = (red, blue)
+                self.suggested_agree = [False] * (len(red) + len(blue))
         else:
             i = random.randint(0, 99)
             if not i:
@@ -505,6 +1102,54 @@ class balance(minqlx.Plugin):
 
         return True
 
+    def cmd_ratingqueue(self, player, msg, channel):
+        """Shows how many rating fetches are waiting and how long they've waited, by priority."""
+        for name, stats in zip(PRIORITY_NAMES, self.scheduler.stats()):
+            channel.reply("^6{}^7: {} queued, {} fetched, {}ms average wait, {}ms longest wait, {} moved up".format(
+                name, stats["queued"], stats["started"], round(1000 * stats["average_wait"]),
+                round(1000 * stats["max_wait"]), stats["promoted"]))
+
+    def cmd_balancestats(self, player, msg, channel):
+        """Shows where ratings were found and how long getting them took. With "export", writes
+        all the statistics as JSON to STATS_FILE in fs_homepath for monitoring to pick up."""
+        stats = self.stats.export()
+        if len(msg) > 1 and msg[1].lower() == "export":
+            if not self.stats_path:
+                channel.reply("There's no fs_homepath to export the statistics to.")
+                return minqlx.RET_STOP_ALL
+            self.export_stats(stats, channel)
+            return
+
+        counters = stats["counters"]
+        channel.reply("Hits/misses: " + ", ".join("{} ^6{}^7/^6{}^7".format(source,
+            counters.get("hits." + source, 0), counters.get("misses." + source, 0))
+            for source in ("memory", "local", "snapshot", "redis", "http")))
+        channel.reply("HTTP failures: ^6{}^7, untracked players: ^6{}^7".format(
+            counters.get("http.failures", 0), counters.get("untracked", 0)))
+        for name in ("http.latency", "http.attempts", "callback.latency"):
+            hist = stats["histograms"].get(name)
+            if hist:
+                channel.reply("{}: ^6{}^7 samples, average ^6{}^7, buckets {}".format(name, hist["count"],
+                    round(hist["sum"] / hist["count"], 3), " ".join("<={}:{}".format(le, n) for le, n in hist["buckets"] if n)))
+
+    @minqlx.thread
+    def export_stats(self, stats, channel):
+        @minqlx.next_frame
+        def reply(msg):
+            channel.reply(msg)
+
+        try:
+            tmp_path = self.stats_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.stats_path)
+        except OSError:
+            minqlx.log_exception(self)
+            reply("Failed to export the statistics.")
+            return
+
+        reply("Statistics exported to {}.".format(self.stats_path))
+
     def cmd_do(self, player, msg, channel):
         """Forces a suggested switch to be done."""
         if self.suggested_pair:
@@ -513,12 +1158,10 @@ class balance(minqlx.Plugin):
     def cmd_agree(self, player, msg, channel):
         """After the bot suggests a switch, players in question can use this to agree to the switch."""
         if self.suggested_pair and not all(self.suggested_agree):
-            p1, p2 = self.suggested_pair
-
-            if p1 == player:
-                self.suggested_agree[0] = True
-            elif p2 == player:
-                self.suggested_agree[1] = True
+            red, blue = self.suggested_pair
+            for i, p in enumerate(red + blue):
+                if p == player:
+                    self.suggested_agree[i] = True
 
             if all(self.suggested_agree):
                 # If the game's in progress and we're not in the round countdown, wait for next round.
@@ -538,83 +1181,751 @@ class balance(minqlx.Plugin):
         players = dict([(p.steam_id, gt) for p in self.players()])
         self.add_request(players, self.callback_ratings, channel)
 
-    def callback_ratings(self, players, channel):
+    def callback_ratings(self, players, channel, refetches=0):
         # We check if people joined while we were requesting ratings and get them if someone did.
         teams = self.teams()
-        current = self.players()
         gt = self.game.type_short
+        if self.fetch_missing(players, self.players(), self.callback_ratings, channel, refetches):
+            return
 
-        for p in current:
-            if p.steam_id not in players:
-                d = dict([(p.steam_id, gt) for p in current])
-                self.add_request(d, self.callback_ratings, channel)
-                return
+        for team, color in (("free", "^6"), ("red", "^1"), ("blue", "^4"), ("spectator", "")):
+            if teams[team]:
+                elos = dict((p, self.ratings.get(p.steam_id, gt).elo) for p in teams[team])
+                ordered = sorted(teams[team], key=lambda p: elos[p], reverse=True)
+                channel.reply(", ".join(["{}: {}{}^7".format(p.clean_name, color, elos[p]) for p in ordered]))
 
-        if teams["free"]:
-            free_sorted = sorted(teams["free"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            free = ", ".join(["{}: ^6{}^7".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in free_sorted])
-            channel.reply(free)
-        if teams["red"]:
-            red_sorted = sorted(teams["red"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            red = ", ".join(["{}: ^1{}^7".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in red_sorted])
-            channel.reply(red)
-        if teams["blue"]:
-            blue_sorted = sorted(teams["blue"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            blue = ", ".join(["{}: ^4{}^7".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in blue_sorted])
-            channel.reply(blue)
-        if teams["spectator"]:
-            spec_sorted = sorted(teams["spectator"], key=lambda x: self.ratings[x.steam_id][gt]["elo"], reverse=True)
-            spec = ", ".join(["{}: {}".format(p.clean_name, self.ratings[p.steam_id][gt]["elo"]) for p in spec_sorted])
-            channel.reply(spec)
-
-    def suggest_switch(self, teams, gametype):
-        """Suggest a switch based on average team ratings."""
-        avg_red = self.team_average(teams["red"], gametype)
-        avg_blue = self.team_average(teams["blue"], gametype)
-        cur_diff = abs(avg_red - avg_blue)
-        min_diff = 999999
-        best_pair = None
-
-        for red_p in teams["red"]:
-            for blue_p in teams["blue"]:
-                r = teams["red"].copy()
-                b = teams["blue"].copy()
-                b.append(red_p)
-                r.remove(red_p)
-                r.append(blue_p)
-                b.remove(blue_p)
-                avg_red = self.team_average(r, gametype)
-                avg_blue = self.team_average(b, gametype)
-                diff = abs(avg_red - avg_blue)
-                if diff < min_diff:
-                    min_diff = diff
-                    best_pair = (red_p, blue_p)
-
-        if min_diff < cur_diff:
-            return (best_pair, cur_diff - min_diff)
-        else:
+    def report_teams(self, model, channel):
+        """Tell the chances of each team winning, and how the current split compares to every other one."""
+        avg_red = model.average("red")
+        avg_blue = model.average("blue")
+        red_chance = expected_score(avg_red, avg_blue)
+        channel.reply("Win probability: ^1{}% ^7vs ^4{}%"
+            .format(round(100 * red_chance), round(100 * (1 - red_chance))))
+
+        ratings = model.ratings("red") + model.ratings("blue")
+        if len(ratings) <= FULL_REPORT_LIMIT:
+            self.report_splits(ratings, model.count["red"], model.difference(), channel)
+
+    @minqlx.thread
+    def report_splits(self, ratings, size, current, channel):
+        """Tell how the current split compares to every other one. Evaluating all of them takes
+        a few hundred milliseconds in big lobbies, so it's done outside the game thread."""
+        diffs = split_differences(ratings, size)
+        better = bisect.bisect_left(diffs, current - 1e-9)
+        quartiles = [diffs[min(len(diffs) - 1, len(diffs) * q // 4)] for q in range(5)]
+
+        @minqlx.next_frame
+        def reply():
+            channel.reply("Optimal difference: ^6{}^7, current split is ^6{}^7 off and beaten by ^6{}^7 of {} splits."
+                .format(round(diffs[0]), round(current - diffs[0]), better, len(diffs)))
+            channel.reply("Differences over all splits: min ^6{}^7, 25% ^6{}^7, median ^6{}^7, 75% ^6{}^7, max ^6{}^7"
+                .format(*[round(d) for d in quartiles]))
+
+        reply()
+
+    def suggest_switch(self, teams, gametype, max_size=1, minimum_diff=0):
+        """Suggest a switch of up to *max_size* players from each team based on average
+        team ratings. Switching more players is only suggested if it improves the
+        difference by at least *minimum_diff* over switching fewer players."""
+        model = teams if isinstance(teams, TeamModel) else self.team_model(teams, gametype)
+        best = None
+        for size in range(1, max_size + 1):
+            switch = model.best_group_switch(size)
+            if switch and (not best or best[2] - switch[2] >= max(minimum_diff, 1e-9)):
+                best = switch
+
+        if not best:
             return None
 
+        red, blue, diff = best
+        return ((red, blue), model.difference() - diff)
+
     def team_average(self, team, gametype):
         """Calculates the average rating of a team."""
-        avg = 0
-        if team:
-            for p in team:
-                avg += self.ratings[p.steam_id][gametype]["elo"]
-            avg /= len(team)
+        if not team:
+            return 0
 
-        return avg
+        return sum(self.ratings.get(p.steam_id, gametype).elo for p in team) / len(team)
+
+    def team_model(self, teams, gametype):
+        """Builds a TeamModel of the red and blue teams using the cached ratings."""
+        return TeamModel(teams["red"], teams["blue"], lambda p: self.ratings.get(p.steam_id, gametype).elo)
 
     def execute_suggestion(self):
-        p1, p2 = self.suggested_pair
+        red, blue = self.suggested_pair
         try:
-            p1.update()
-            p2.update()
+            for p in red + blue:
+                p.update()
         except minqlx.NonexistentPlayerError:
             return
 
-        if p1.team != "spectator" and p2.team != "spectator":
-            self.switch(self.suggested_pair[0], self.suggested_pair[1])
+        if all(p.team != "spectator" for p in red + blue):
+            for p1, p2 in zip(red, blue):
+                self.switch(p1, p2)
 
         self.suggested_pair = None
-        self.suggested_agree = [False, False]
+        self.suggested_agree = []
+
+
+# ====================================================================
+#                           RATING STORE
+# ====================================================================
+
+class Rating:
+    """A cached rating. A time of -1 means it never expires. Negative ratings are placeholders
+    for players a fetch failed for. They keep the API from being asked again right away,
+    but they aren't ratings and are never used as one."""
+    __slots__ = ("elo", "games", "time", "local", "negative")
+
+    def __init__(self, elo, games=-1, time=-1, local=False, negative=False):
+        self.elo = elo
+        self.games = games
+        self.time = time
+        self.local = local
+        self.negative = negative
+
+    def __eq__(self, other):
+        return isinstance(other, Rating) and all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+    def __repr__(self):
+        return "Rating({})".format(", ".join("{}={!r}".format(a, getattr(self, a)) for a in self.__slots__))
+
+class RatingStore:
+    """Cached ratings, one row per player with a column per supported game type.
+    Holds at most max_players players and drops the least recently used first."""
+    columns = dict((gt, i) for i, gt in enumerate(EXT_SUPPORTED_GAMETYPES))
+
+    def __init__(self, max_players=MAX_CACHED_PLAYERS):
+        self.max_players = max_players
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, steam_id, gametype):
+        col = self.columns.get(gametype)
+        with self.lock:
+            row = self.rows.get(steam_id)
+            if row is None or col is None:
+                return None
+            self.rows.move_to_end(steam_id)
+            return row[col]
+
+    def put(self, steam_id, gametype, rating):
+        col = self.columns.get(gametype)
+        if col is None:
+            return
+        with self.lock:
+            self._put(steam_id, col, rating)
+
+    def _put(self, steam_id, col, rating):
+        row = self.rows.get(steam_id)
+        if row is None:
+            row = self.rows[steam_id] = [None] * len(self.columns)
+            if len(self.rows) > self.max_players:
+                self.rows.popitem(last=False)
+        else:
+            self.rows.move_to_end(steam_id)
+        row[col] = rating
+
+    def put_missing(self, steam_id, gametype, rating):
+        """Put a rating unless the player already has one in the game type."""
+        col = self.columns.get(gametype)
+        if col is None:
+            return
+        with self.lock:
+            row = self.rows.get(steam_id)
+            if row is None or row[col] is None:
+                self._put(steam_id, col, rating)
+
+    def expire(self, steam_id, gametype=None):
+        """Drop a player's rating in a game type, or all of them if no game type is given."""
+        with self.lock:
+            if gametype is None:
+                self.rows.pop(steam_id, None)
+            elif steam_id in self.rows and gametype in self.columns:
+                self.rows[steam_id][self.columns[gametype]] = None
+
+    def gametypes(self, steam_id):
+        with self.lock:
+            row = self.rows.get(steam_id) or ()
+            return dict((gt, row[i]) for gt, i in self.columns.items() if row and row[i])
+
+    def items(self):
+        with self.lock:
+            return [(sid, gt, row[i]) for sid, row in self.rows.items() for gt, i in self.columns.items() if row[i]]
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    def __contains__(self, steam_id):
+        with self.lock:
+            return steam_id in self.rows
+
+    def __len__(self):
+        with self.lock:
+            return len(self.rows)
+
+
+class ExpiringCache:
+    """A dictionary-like cache where entries expire after ttl seconds. If it holds more than
+    max_size entries, the least recently used are evicted. Keeps count of hits, misses and
+    evictions, which include entries that expired, so the size can be tuned."""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Keys: key - Items: (value, time it was put)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() >= entry[1] + self.ttl:
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[0] if entry else default
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and time.time() < entry[1] + self.ttl
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+# ====================================================================
+#                             SNAPSHOT
+# ====================================================================
+
+def write_snapshot(path, ratings):
+    """Write ratings keyed by (steam_id, gametype) to a file. The file is written under
+    a temporary name and then renamed, so a crash can never leave a partial snapshot."""
+    records = b"".join(SNAPSHOT_RECORD.pack(sid, gt.encode(), rating.elo, rating.games, rating.time)
+                       for (sid, gt), rating in ratings.items())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(b"QLXR", SNAPSHOT_VERSION, len(ratings), zlib.crc32(records)))
+        f.write(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_snapshot(path):
+    """Read a snapshot written by write_snapshot. Returns an empty dict if there is no snapshot
+    or it's from another version, and raises ValueError if it's corrupt."""
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, count, crc = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != b"QLXR":
+        raise ValueError("Not a rating snapshot.")
+    elif version != SNAPSHOT_VERSION:
+        return {}
+
+    records = data[SNAPSHOT_HEADER.size:]
+    if len(records) != count * SNAPSHOT_RECORD.size or zlib.crc32(records) != crc:
+        raise ValueError("Corrupt rating snapshot.")
+
+    res = {}
+    for sid, gt, elo, games, t in SNAPSHOT_RECORD.iter_unpack(records):
+        if elo.is_integer():
+            elo = int(elo)
+        res[(sid, gt.rstrip(b"\0").decode())] = Rating(elo, games, t)
+    return res
+
+
+# ====================================================================
+#                           LOCAL RATINGS
+# ====================================================================
+
+def expected_score(red_rating, blue_rating):
+    """The chance of red winning according to the Elo model."""
+    return 1 / (1 + 10 ** ((blue_rating - red_rating) / 400))
+
+def update_elo(ratings, games, red, blue, score):
+    """Elo update after a team game, treating each team as a player with the average
+    rating of its members. Returns a dict with the new rating of every player."""
+    red_avg = sum(ratings[sid] for sid in red) / len(red)
+    blue_avg = sum(ratings[sid] for sid in blue) / len(blue)
+    surprise = score - expected_score(red_avg, blue_avg)
+
+    res = {}
+    for sid in red + blue:
+        k = ELO_K_FACTOR * (2 if games.get(sid, 0) < ELO_PROVISIONAL_GAMES else 1)
+        res[sid] = round(ratings[sid] + (k * surprise if sid in red else -k * surprise))
+    return res
+
+def fit_ratings(matches, epochs=ELO_FIT_EPOCHS):
+    """Compute ratings from scratch for a list of (red steam IDs, blue steam IDs, score) games.
+
+    Rather than replaying the games one by one, every pass updates all ratings at once
+    with each player's average surprise over all their games. This converges to the
+    ratings that best explain the whole history regardless of the order of the games.
+    Uses numpy if it's available.
+
+    """
+    sids = sorted(set(sid for red, blue, _ in matches for sid in red + blue))
+    if not sids:
+        return {}
+    index = dict((sid, i) for i, sid in enumerate(sids))
+    # One entry per player per game: the game, the player and its weight in the team average.
+    game_idx, player_idx, weights = [], [], []
+    for g, (red, blue, _) in enumerate(matches):
+        for team, sign in ((red, 1), (blue, -1)):
+            for sid in team:
+                game_idx.append(g)
+                player_idx.append(index[sid])
+                weights.append(sign / len(team))
+    scores = [score for _, _, score in matches]
+    step = ELO_K_FACTOR * 4
+
+    if numpy is not None:
+        game_idx, player_idx = numpy.array(game_idx), numpy.array(player_idx)
+        weights, scores = numpy.array(weights), numpy.array(scores, dtype=float)
+        signs = numpy.sign(weights)
+        played = numpy.bincount(player_idx, minlength=len(sids))
+        ratings = numpy.full(len(sids), float(DEFAULT_RATING))
+        for _ in range(epochs):
+            diff = numpy.bincount(game_idx, weights=weights * ratings[player_idx], minlength=len(matches))
+            surprise = scores - 1 / (1 + 10 ** (-diff / 400))
+            ratings += step * numpy.bincount(player_idx, weights=signs * surprise[game_idx],
+                                             minlength=len(sids)) / played
+        ratings = ratings.tolist()
+    else:
+        played = [0] * len(sids)
+        for i in player_idx:
+            played[i] += 1
+        ratings = [float(DEFAULT_RATING)] * len(sids)
+        entries = list(zip(game_idx, player_idx, weights))
+        for _ in range(epochs):
+            diff = [0] * len(matches)
+            for g, i, w in entries:
+                diff[g] += w * ratings[i]
+            surprise = [s - 1 / (1 + 10 ** (-d / 400)) for s, d in zip(scores, diff)]
+            total = [0] * len(sids)
+            for g, i, w in entries:
+                total[i] += surprise[g] if w > 0 else -surprise[g]
+            ratings = [r + step * t / n for r, t, n in zip(ratings, total, played)]
+
+    return dict((sid, round(r)) for sid, r in zip(sids, ratings))
+
+
+# ====================================================================
+#                            STATISTICS
+# ====================================================================
+
+class BalanceStats:
+    """Thread-safe counters and histograms of how ratings are looked up, for !balancestats."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        # Keys: name - Items: [upper bounds, counts per bucket with one more for overflow, count, sum]
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def lookup(self, source, hits, misses):
+        """Count ratings that were and weren't found in a source."""
+        with self.lock:
+            self.counters["hits." + source] = self.counters.get("hits." + source, 0) + hits
+            self.counters["misses." + source] = self.counters.get("misses." + source, 0) + misses
+
+    def observe(self, name, value, buckets):
+        with self.lock:
+            if name not in self.histograms:
+                buckets = tuple(buckets)
+                self.histograms[name] = [buckets, [0] * (len(buckets) + 1), 0, 0]
+            hist = self.histograms[name]
+            hist[1][bisect.bisect_left(hist[0], value)] += 1
+            hist[2] += 1
+            hist[3] += value
+
+    def export(self):
+        """Everything as a JSON serializable dict. Histogram buckets are pairs of an upper
+        bound and the number of values up to it that weren't in a lower bucket. The last
+        bucket has an upper bound of "inf"."""
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": dict((name, {
+                    "buckets": [[le, n] for le, n in zip(list(bounds) + ["inf"], counts)],
+                    "count": count, "sum": total})
+                    for name, (bounds, counts, count, total) in self.histograms.items()),
+            }
+
+
+# ====================================================================
+#                            TEAM MODEL
+# ====================================================================
+
+class TeamModel:
+    """Keeps the rating sum and player count of both teams, along with each team's
+    ratings in sorted order, so that the outcome of a switch can be worked out in
+    constant time and the best switch found with a binary search.
+
+    """
+    def __init__(self, red, blue, rating):
+        self.sum = {"red": 0, "blue": 0}
+        self.count = {"red": 0, "blue": 0}
+        # Each team's ratings in ascending order with the players in a parallel list.
+        self._ratings = {"red": [], "blue": []}
+        self._players = {"red": [], "blue": []}
+        self._rating = rating
+        # Sorted sums of every group of players by team and group size, built on demand.
+        self._groups = {}
+
+        for p in red:
+            self.add(p, "red")
+        for p in blue:
+            self.add(p, "blue")
+
+    def add(self, player, team, rating=None):
+        if rating is None:
+            rating = self._rating(player)
+        i = bisect.bisect_right(self._ratings[team], rating)
+        self._ratings[team].insert(i, rating)
+        self._players[team].insert(i, player)
+        self.sum[team] += rating
+        self.count[team] += 1
+        self._groups.clear()
+
+    def remove(self, player, team):
+        i = self._players[team].index(player)
+        rating = self._ratings[team].pop(i)
+        del self._players[team][i]
+        self.sum[team] -= rating
+        self.count[team] -= 1
+        self._groups.clear()
+        return rating
+
+    def switch(self, red_player, blue_player):
+        """Moves a red player to blue and a blue player to red."""
+        red_rating = self.remove(red_player, "red")
+        blue_rating = self.remove(blue_player, "blue")
+        self.add(red_player, "blue", red_rating)
+        self.add(blue_player, "red", blue_rating)
+
+    def players(self, team):
+        return list(self._players[team])
+
+    def ratings(self, team):
+        return list(self._ratings[team])
+
+    def average(self, team):
+        return self.sum[team] / self.count[team] if self.count[team] else 0
+
+    def difference(self):
+        return rating_difference(self.sum["red"], self.count["red"], self.sum["blue"], self.count["blue"])
+
+    def switch_difference(self, red_rating, blue_rating):
+        """The difference between the team averages if players with the given ratings switched."""
+        delta = blue_rating - red_rating
+        return rating_difference(self.sum["red"] + delta, self.count["red"],
+                                 self.sum["blue"] - delta, self.count["blue"])
+
+    def best_switch(self):
+        """Find the 1-for-1 switch that minimizes the difference. Returns a tuple with the
+        red player, the blue player and the new difference, or None if no switch helps."""
+        switch = self.best_group_switch(1)
+        if not switch:
+            return None
+
+        (red_p,), (blue_p,), diff = switch
+        return red_p, blue_p, diff
+
+    def best_group_switch(self, size):
+        """Find the size-for-size switch that minimizes the difference. Returns a tuple with
+        the red players, the blue players and the new difference, or None if no switch helps."""
+        # Switching more than half a team is the same as switching the rest of it.
+        if not self.count["red"] or not self.count["blue"]:
+            return None
+        elif size < 1 or size > max(1, min(self.count["red"], self.count["blue"]) // 2):
+            return None
+
+        # Moving (blue sum - red sum) from blue to red changes the difference linearly,
+        # so for each red group the ideal blue group is the one closest to this offset.
+        offset = ((self.average("blue") - self.average("red")) /
+                  (1 / self.count["red"] + 1 / self.count["blue"]))
+        red_sums, red_groups = self._group_sums("red", size)
+        blue_sums, blue_groups = self._group_sums("blue", size)
+        best = None
+        best_diff = self.difference()
+        for i, red_sum in enumerate(red_sums):
+            j = bisect.bisect_left(blue_sums, red_sum + offset)
+            for k in (j - 1, j):
+                if 0 <= k < len(blue_sums):
+                    diff = self.switch_difference(red_sum, blue_sums[k])
+                    if diff < best_diff:
+                        best_diff = diff
+                        best = (i, k)
+
+        if best is None:
+            return None
+
+        red = tuple(self._players["red"][i] for i in red_groups[best[0]])
+        blue = tuple(self._players["blue"][i] for i in blue_groups[best[1]])
+        return red, blue, best_diff
+
+    def _group_sums(self, team, size):
+        """The rating sums of every group of *size* players in a team in ascending order,
+        along with a parallel list of tuples with the indices of the players in each group."""
+        if (team, size) not in self._groups:
+            ratings = self._ratings[team]
+            if size == 1:
+                groups = [(r, (i,)) for i, r in enumerate(ratings)]
+            else:
+                groups = sorted(((sum(ratings[i] for i in c), c)
+                                 for c in itertools.combinations(range(len(ratings)), size)),
+                                key=lambda g: g[0])
+            self._groups[(team, size)] = ([g[0] for g in groups], [g[1] for g in groups])
+
+        return self._groups[(team, size)]
+
+
+class TeamTracker:
+    """Keeps the rating sums of red and blue up to date as players join, leave and switch
+    teams, so that where a joining player should go can be worked out in constant time.
+    Players without a known rating leave it incomplete until they're off the teams again."""
+    def __init__(self):
+        self.model = TeamModel((), (), None)
+        # Keys: steam_id - Items: team
+        self.teams = {}
+        self.unrated = set()
+
+    def move(self, steam_id, team, rating):
+        """Put a player on a team, or take them off the teams if it's neither red nor blue."""
+        self.remove(steam_id)
+        if team not in ("red", "blue"):
+            return
+
+        self.teams[steam_id] = team
+        if rating is None:
+            self.unrated.add(steam_id)
+        else:
+            self.model.add(steam_id, team, rating)
+
+    def remove(self, steam_id):
+        team = self.teams.pop(steam_id, None)
+        if steam_id in self.unrated:
+            self.unrated.remove(steam_id)
+        elif team:
+            self.model.remove(steam_id, team)
+
+    def complete(self):
+        return not self.unrated
+
+    def placement(self, rating, team):
+        """The team a player with *rating* joining *team* is better off on, along with how much it
+        improves the difference. Teams that would end up with more players than the other are
+        not considered. The player should not be tracked yet."""
+        m = self.model
+        diffs = {}
+        for t, other in (("red", "blue"), ("blue", "red")):
+            if m.count[t] <= m.count[other]:
+                added = dict((x, m.sum[x] + (rating if x == t else 0)) for x in ("red", "blue"))
+                counts = dict((x, m.count[x] + (1 if x == t else 0)) for x in ("red", "blue"))
+                diffs[t] = rating_difference(added["red"], counts["red"], added["blue"], counts["blue"])
+
+        if team not in diffs:
+            return team, 0
+        best = min(diffs, key=lambda t: diffs[t])
+        return best, diffs[team] - diffs[best]
+
+
+# ====================================================================
+#                           PARTITIONING
+# ====================================================================
+
+def rating_difference(red_sum, red_count, blue_sum, blue_count):
+    """The absolute difference between the average ratings of two teams."""
+    red_avg = red_sum / red_count if red_count else 0
+    blue_avg = blue_sum / blue_count if blue_count else 0
+    return abs(red_avg - blue_avg)
+
+def best_partition(ratings, size):
+    """Split a list of ratings into a group of *size* and the rest so that the
+    difference between the average of both groups is as small as possible.
+
+    Returns a tuple with the set of indices that go into the first group and the
+    resulting difference. Lobbies of up to EXACT_PARTITION_LIMIT players are solved
+    exactly with a meet-in-the-middle search over subset sums, anything bigger falls
+    back to a greedy split refined with swaps for at most PARTITION_TIME_BUDGET.
+
+    """
+    n = len(ratings)
+    if size < 0 or size > n:
+        raise ValueError("Invalid group size.")
+
+    if not n:
+        return set(), 0
+    elif n > EXACT_PARTITION_LIMIT:
+        return _heuristic_partition(ratings, size, time.monotonic() + PARTITION_TIME_BUDGET)
+
+    total = sum(ratings)
+    # For a fixed group size the difference in averages is monotonic in the
+    # group's sum, so we are really looking for the sum closest to this target.
+    target = total * size / n
+    half = n // 2
+    left = _subset_sums(ratings[:half], 0)
+    right = _subset_sums(ratings[half:], half)
+    # The groups are interchangeable when they have the same size, so the first
+    # player can always be kept in the first group to halve the search space.
+    symmetric = n == 2 * size
+
+    best_mask = None
+    best_dist = None
+    for count in range(max(0, size - (n - half)), min(size, half) + 1):
+        sums, masks = right[size - count]
+        if not sums:
+            continue
+        for left_sum, left_mask in zip(*left[count]):
+            if symmetric and not left_mask & 1:
+                continue
+            want = target - left_sum
+            i = bisect.bisect_left(sums, want)
+            for j in (i - 1, i):
+                if 0 <= j < len(sums):
+                    dist = abs(want - sums[j])
+                    if best_dist is None or dist < best_dist:
+                        best_dist = dist
+                        best_mask = left_mask | masks[j]
+            if best_dist == 0:
+                break
+        if best_dist == 0:
+            break
+
+    group = set(i for i in range(n) if best_mask >> i & 1)
+    group_sum = sum(ratings[i] for i in group)
+    return group, rating_difference(group_sum, size, total - group_sum, n - size)
+
+def split_differences(ratings, size):
+    """The difference between the average ratings of the two groups for every way to split
+    *ratings* into a group of *size* and the rest, in ascending order. Uses numpy if it's
+    available, in which case all splits are evaluated at once."""
+    n = len(ratings)
+    if size < 0 or size > n:
+        raise ValueError("Invalid group size.")
+
+    total = sum(ratings)
+    if numpy is None:
+        return sorted(rating_difference(s, size, total - s, n - size)
+                      for s in map(sum, itertools.combinations(ratings, size)))
+
+    members = _split_members(n, size)
+    values = numpy.array(ratings, dtype=float)
+    sums = numpy.zeros(len(members))
+    for column in members.T:
+        sums += values[column]
+    red_avg = sums / size if size else 0
+    blue_avg = (total - sums) / (n - size) if n - size else 0
+    return numpy.sort(numpy.abs(red_avg - blue_avg))
+
+_split_members_cache = OrderedDict()
+_split_members_lock = threading.Lock()
+def _split_members(n, size):
+    """A matrix with a row for every subset of *size* out of *n*, holding the indices of
+    its members. The same lobby sizes come up over and over, so the last few are cached."""
+    key = (n, size)
+    with _split_members_lock:
+        if key in _split_members_cache:
+            _split_members_cache.move_to_end(key)
+            return _split_members_cache[key]
+
+        rows = _binomial(n, size)
+        members = numpy.fromiter(itertools.chain.from_iterable(itertools.combinations(range(n), size)),
+                                 dtype=numpy.uint8, count=rows * size).reshape(rows, size)
+        _split_members_cache[key] = members
+        if len(_split_members_cache) > SPLIT_CACHE_SIZE:
+            _split_members_cache.popitem(last=False)
+        return members
+
+def _binomial(n, k):
+    result = 1
+    for i in range(min(k, n - k)):
+        result = result * (n - i) // (i + 1)
+    return result
+
+def _subset_sums(ratings, offset):
+    """Enumerate every subset of *ratings* and bucket them by size. Each bucket is a
+    pair of lists with the sums in ascending order and their bitmasks."""
+    subsets = [(0, 0, 0)]
+    for i, rating in enumerate(ratings):
+        bit = 1 << (i + offset)
+        subsets += [(s + rating, c + 1, m | bit) for s, c, m in subsets]
+
+    buckets = [[] for _ in range(len(ratings) + 1)]
+    for s, c, m in subsets:
+        buckets[c].append((s, m))
+
+    res = []
+    for bucket in buckets:
+        bucket.sort()
+        res.append(([s for s, _ in bucket], [m for _, m in bucket]))
+    return res
+
+def _heuristic_partition(ratings, size, deadline):
+    """Greedy split of the ratings in descending order, followed by 1-for-1 swaps
+    until no swap helps or the deadline is hit. Not guaranteed to be optimal."""
+    n = len(ratings)
+    total = sum(ratings)
+    group, others = set(), []
+    group_sum = others_sum = 0
+    for i in sorted(range(n), key=lambda i: ratings[i], reverse=True):
+        # Give the player to whichever side is furthest behind relative to its final size.
+        if len(others) == n - size or (len(group) < size and group_sum * (n - size) <= others_sum * size):
+            group.add(i)
+            group_sum += ratings[i]
+        else:
+            others.append(i)
+            others_sum += ratings[i]
+
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        cur = rating_difference(group_sum, size, total - group_sum, n - size)
+        for a in list(group):
+            for b in others:
+                s = group_sum - ratings[a] + ratings[b]
+                if rating_difference(s, size, total - s, n - size) < cur:
+                    group.remove(a)
+                    group.add(b)
+                    others.remove(b)
+                    others.append(a)
+                    group_sum = s
+                    improved = True
+                    break
+            if improved or time.monotonic() >= deadline:
+                break
+
+    return group, rating_difference(group_sum, size, total - group_sum, n - size)
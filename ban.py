@@ -18,9 +18,15 @@
 
 import minqlx
 import datetime
+import threading
 import time
 import re
 
+try:
+    from .sanctions import SanctionStore, SanctionFeed, parse_sanction
+except ImportError:
+    from sanctions import SanctionStore, SanctionFeed, parse_sanction
+
 LENGTH_REGEX = re.compile(r"(?P<number>[0-9]+) (?P<scale>seconds?|minutes?|hours?|days?|weeks?|months?|years?)")
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 PLAYER_KEY = "minqlx:players:{}"
@@ -35,22 +41,61 @@ class ban(minqlx.Plugin):
         self.add_hook("game_start", self.handle_game_start)
         self.add_hook("game_end", self.handle_game_end)
         self.add_hook("team_switch", self.handle_team_switch)
+        self.add_hook("new_game", self.handle_new_game)
+        self.add_hook("unload", self.handle_unload)
         self.add_command("ban", self.cmd_ban, 2, usage="<id> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unban", self.cmd_unban, 2, usage="<id>")
         self.add_command("checkban", self.cmd_checkban, usage="<id>")
         self.add_command("forgive", self.cmd_forgive, 2, usage="<id> [leaves_to_forgive]")
+        self.add_command("compactbans", self.cmd_compactbans, 5)
 
         # Cvars.
         self.set_cvar_once("qlx_leaverBan", "0")
         self.set_cvar_limit_once("qlx_leaverBanThreshold", "0.63", "0", "1")
         self.set_cvar_limit_once("qlx_leaverBanWarnThreshold", "0.78", "0", "1")
         self.set_cvar_once("qlx_leaverBanMinimumGames", "15")
+        self.set_cvar_once("qlx_banCompactInterval", "24")
 
         # List of players playing that could potentially be considered leavers.
         self.players_start = []
         self.pending_warnings = {}
 
+        # Everything needed to check a connecting player, so that it doesn't take any database calls.
+        # Until it's loaded, players are checked against the database like before.
+        self.index_lock = threading.Lock()
+        self.index_ready = False
+        # Keys: steam_id - Items: (expiry epoch, reason) of their longest active ban.
+        self.bans = {}
+        # Keys: steam_id - Items: [games completed, games left], with None for keys not in the database.
+        # Only kept while automatic leaver bans are on.
+        self.leaves = {}
+        # Players whose entries changed while the index was loading, to be read again once it's loaded.
+        self.index_changes = set()
+        # Bumped every time the index is loaded again, so that a load that's been superseded is dropped.
+        self.index_generation = 0
+        self.sanctions = SanctionStore(self.db, "bans", self.logger)
+
+        self.cache_cvars()
+        self.load_index(self.index_generation)
+
+        # Other servers sharing the database let us know about their bans and leaves through this.
+        self.feed = SanctionFeed(self.db, ("ban", "unban", "leaves"))
+        self.unloaded = False
+        self.subscribe()
+        self.compact_periodically()
+
+    def cache_cvars(self):
+        self.leaver_ban = self.get_cvar("qlx_leaverBan", bool)
+        self.min_games_completed = self.get_cvar("qlx_leaverBanMinimumGames", int)
+        self.warn_threshold = self.get_cvar("qlx_leaverBanWarnThreshold", float)
+        self.ban_threshold = self.get_cvar("qlx_leaverBanThreshold", float)
+        self.compact_interval = int(self.get_cvar("qlx_banCompactInterval", float) * 3600)
+
     def handle_player_connect(self, player):
+        if self.index_ready and not self.feed.subscribed:
+            # We might have missed bans from other servers, so we check the database in the background.
+            self.refresh_player(player.steam_id)
+
         status = self.leave_status(player.steam_id)
         # Check if a player has been banned for leaving, if we're doing that.
         if status and status[0] == "ban":
@@ -85,6 +130,20 @@ class ban(minqlx.Plugin):
         if len(teams["red"] + teams["blue"]) % 2 != 0 and player in self.players_start:
             self.players_start.remove(player)
 
+    def handle_new_game(self):
+        leaver_ban = self.leaver_ban
+        self.cache_cvars()
+        # Leaves are only in the index while automatic leaver bans are on.
+        if self.leaver_ban and not leaver_ban:
+            self.reload_index()
+        elif leaver_ban and not self.leaver_ban:
+            with self.index_lock:
+                self.leaves = {}
+
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.unloaded = True
+
     def handle_game_countdown(self):
         if self.get_cvar("qlx_leaverBan", bool):
             self.msg("Leavers are being kept track of. Repeat offenders ^6will^7 be banned.")
@@ -117,7 +176,12 @@ class ban(minqlx.Plugin):
             db.incr(PLAYER_KEY.format(player.steam_id) + ":games_completed")
         for player in leavers:
             db.incr(PLAYER_KEY.format(player.steam_id) + ":games_left")
-        db.execute()
+        counts = db.execute()
+
+        completed = dict((p.steam_id, n) for p, n in zip(self.players_start, counts))
+        left = dict((p.steam_id, n) for p, n in zip(leavers, counts[len(self.players_start):]))
+        self.index_leaves(completed, left)
+        self.feed.publish("leaves", completed=completed, left=left)
 
         if leavers:
             self.msg("^7Leavers: ^6{}".format(" ".join([p.clean_name for p in leavers])))
@@ -194,15 +258,11 @@ class ban(minqlx.Plugin):
             elif scale == "year":
                 td = datetime.timedelta(weeks=number * 52)
 
-            now = datetime.datetime.now().strftime(TIME_FORMAT)
-            expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
-            base_key = PLAYER_KEY.format(ident) + ":bans"
-            ban_id = self.db.zcard(base_key)
-            db = self.db.pipeline()
-            db.zadd(base_key, time.time() + td.total_seconds(), ban_id)
-            ban = {"expires": expires, "reason": reason, "issued": now, "issued_by": player.steam_id}
-            db.hmset(base_key + ":{}".format(ban_id), ban)
-            db.execute()
+            score = int(time.time() + td.total_seconds())
+            self.sanctions.create(ident, score, reason, player.steam_id)
+            self.index_ban(ident, score, reason)
+            self.feed.publish("ban", steam_id=ident, expires=score, reason=reason)
+            expires = datetime.datetime.fromtimestamp(score).strftime(TIME_FORMAT)
 
             try:
                 self.kick(ident, "has been banned until ^6{}^7: {}".format(expires, reason))
@@ -232,15 +292,13 @@ class ban(minqlx.Plugin):
         else:
             name = ident
 
-        base_key = PLAYER_KEY.format(ident) + ":bans"
-        bans = self.db.zrangebyscore(base_key, time.time(), "+inf", withscores=True)
-        if not bans:
+        if not self.sanctions.lift(ident):
             channel.reply("^7 No active bans on ^6{}^7 found.".format(name))
         else:
-            db = self.db.pipeline()
-            for ban_id, score in bans:
-                db.zincrby(base_key, ban_id, -score)
-            db.execute()
+            with self.index_lock:
+                self.bans.pop(ident, None)
+                self.index_changed(ident)
+            self.feed.publish("unban", steam_id=ident)
             channel.reply("^6{}^7 has been unbanned.".format(name))
 
     def cmd_checkban(self, player, msg, channel):
@@ -329,7 +387,10 @@ class ban(minqlx.Plugin):
                 channel.reply("Unintelligible number of leaves to forgive. Please use numbers.")
                 return
 
-        new_leaves = leaves - leaves_to_forgive
+        new_leaves = max(0, leaves - leaves_to_forgive)
+        self.index_leaves({}, {ident: new_leaves})
+        self.feed.publish("leaves", completed={}, left={ident: new_leaves})
+
         if new_leaves <= 0:
             self.db[base_key + ":games_left"] = 0
             channel.reply("^6{}^7's leaves have been reduced to ^60^7.".format(name))
@@ -343,38 +404,49 @@ class ban(minqlx.Plugin):
     #                               HELPERS
     # ====================================================================
 
+    def cmd_compactbans(self, player, msg, channel):
+        """Archives expired bans right away instead of waiting for the next scheduled compaction."""
+        channel.reply("^7Compacting expired bans...")
+        self.sanctions.compact_now(channel)
+
     def is_banned(self, steam_id):
-        base_key = PLAYER_KEY.format(steam_id) + ":bans"
-        bans = self.db.zrangebyscore(base_key, time.time(), "+inf", withscores=True)
-        if not bans:
+        if self.index_ready:
+            ban = self.bans.get(steam_id)
+            if ban and ban[0] > time.time():
+                return datetime.datetime.fromtimestamp(int(ban[0])), ban[1]
             return None
 
-        longest_ban = self.db.hgetall(base_key + ":{}".format(bans[-1][0]))
-        expires = datetime.datetime.strptime(longest_ban["expires"], TIME_FORMAT)
-        if (expires - datetime.datetime.now()).total_seconds() > 0:
-            return expires, longest_ban["reason"]
+        # Only bans that haven't expired yet are returned.
+        longest_ban = self.sanctions.longest(steam_id)
+        if not longest_ban:
+            return None
 
-        return None
+        return datetime.datetime.fromtimestamp(int(longest_ban[1])), longest_ban[2].get("reason", "")
 
     def leave_status(self, steam_id):
         """Get a player's status when it comes to leaving, given automatic leaver ban is on.
 
         """
-        if not self.get_cvar("qlx_leaverBan", bool):
+        if not self.leaver_ban:
             return None
 
-        try:
-            completed = self.db[PLAYER_KEY.format(steam_id) + ":games_completed"]
-            left = self.db[PLAYER_KEY.format(steam_id) + ":games_left"]
-        except KeyError:
-            return None
+        if self.index_ready:
+            completed, left = self.leaves.get(steam_id, (None, None))
+            if completed is None or left is None:
+                return None
+        else:
+            try:
+                completed = self.db[PLAYER_KEY.format(steam_id) + ":games_completed"]
+                left = self.db[PLAYER_KEY.format(steam_id) + ":games_left"]
+            except KeyError:
+                return None
 
         completed = int(completed)
         left = int(left)
 
-        min_games_completed = self.get_cvar("qlx_leaverBanMinimumGames", int)
-        warn_threshold = self.get_cvar("qlx_leaverBanWarnThreshold", float)
-        ban_threshold = self.get_cvar("qlx_leaverBanThreshold", float)
+        min_games_completed = self.min_games_completed
+        warn_threshold = self.warn_threshold
+        ban_threshold = self.ban_threshold
 
         # Check their games completed to total games ratio.
         total = completed + left
@@ -396,6 +468,150 @@ class ban(minqlx.Plugin):
 
         return action, completed / total
 
+    def index_ban(self, steam_id, expires, reason):
+        """Put a new ban in the index if it's longer than the one they already have."""
+        with self.index_lock:
+            ban = self.bans.get(steam_id)
+            if not ban or ban[0] < expires:
+                self.bans[steam_id] = (expires, reason)
+            self.index_changed(steam_id)
+
+    def index_leaves(self, completed, left):
+        """Put new counts of games completed and left in the index, each a dict with steam IDs as keys."""
+        if not self.leaver_ban:
+            return
+
+        with self.index_lock:
+            for i, counts in enumerate((completed, left)):
+                for steam_id, count in counts.items():
+                    steam_id = int(steam_id)
+                    self.leaves.setdefault(steam_id, [None, None])[i] = int(count)
+                    self.index_changed(steam_id)
+
+    def index_changed(self, steam_id):
+        """Remember a player whose entries changed while the index is loading.
+        Must be called with index_lock held."""
+        if not self.index_ready:
+            self.index_changes.add(steam_id)
+
+    def reload_index(self):
+        """Load the index again from scratch. Players are checked against the database until it's done."""
+        with self.index_lock:
+            self.index_ready = False
+            self.index_generation += 1
+            generation = self.index_generation
+        self.load_index(generation)
+
+    @minqlx.thread
+    def load_index(self, generation):
+        """Load every active ban into memory, and every player's leaves if automatic leaver bans
+        are on. Uses SCAN and pipelines, so it's a handful of round trips per thousand players."""
+        bans = {}
+        for sid, ban in self.sanctions.all_longest():
+            bans[sid] = (ban[1], ban[2].get("reason", ""))
+
+        leaves = {}
+        for i, suffix in enumerate((":games_completed", ":games_left") if self.leaver_ban else ()):
+            keys = list(self.db.scan_iter(match=PLAYER_KEY.format("*") + suffix, count=1000))
+            for j in range(0, len(keys), 1000):
+                chunk = keys[j:j + 1000]
+                for key, value in zip(chunk, self.db.mget(chunk)):
+                    sid = key.split(":")[2]
+                    if value is not None and sid.isdigit():
+                        leaves.setdefault(int(sid), [None, None])[i] = int(value)
+
+        with self.index_lock:
+            if generation != self.index_generation:
+                return
+            self.bans = bans
+            self.leaves = leaves
+
+        # What we read might be older than changes made in the meantime, so we read those players again.
+        while True:
+            with self.index_lock:
+                if generation != self.index_generation:
+                    return
+                changed = self.index_changes
+                self.index_changes = set()
+                if not changed:
+                    self.index_ready = True
+                    return
+            for sid in changed:
+                self.read_player(sid)
+
+    @minqlx.thread
+    def refresh_player(self, steam_id):
+        """Update a player's entries in the index from the database, and kick them
+        if it turns out another server banned them."""
+        if self.read_player(steam_id):
+            self.kick_banned(steam_id)
+
+    def read_player(self, steam_id):
+        """Read a player's entries in the index from the database. Returns whether they're banned."""
+        base_key = PLAYER_KEY.format(steam_id)
+        leaver_ban = self.leaver_ban
+        db = self.db.pipeline()
+        self.sanctions.longest(steam_id, client=db)
+        if leaver_ban:
+            db.get(base_key + ":games_completed")
+            db.get(base_key + ":games_left")
+        ban, *counts = db.execute()
+        ban = parse_sanction(ban)
+
+        with self.index_lock:
+            if ban:
+                self.bans[steam_id] = (ban[1], ban[2].get("reason", ""))
+            else:
+                self.bans.pop(steam_id, None)
+            if not leaver_ban:
+                return bool(ban)
+
+            completed, left = counts
+            if completed is None and left is None:
+                self.leaves.pop(steam_id, None)
+            else:
+                self.leaves[steam_id] = [None if completed is None else int(completed),
+                                         None if left is None else int(left)]
+
+        return bool(ban)
+
+    @minqlx.thread
+    def subscribe(self):
+        """Listen for bans, unbans and leaves from other servers and apply them right away."""
+        self.feed.listen(self, self.handle_sanction)
+
+    def handle_sanction(self, event):
+        if event["type"] == "leaves":
+            self.index_leaves(event["completed"], event["left"])
+            return
+
+        steam_id = int(event["steam_id"])
+        if event["type"] == "ban":
+            self.index_ban(steam_id, event["expires"], event["reason"] or "")
+            self.kick_banned(steam_id)
+        elif event["type"] == "unban":
+            with self.index_lock:
+                self.bans.pop(steam_id, None)
+                self.index_changed(steam_id)
+
+    @minqlx.thread
+    def compact_periodically(self):
+        """Archive expired bans every qlx_banCompactInterval hours."""
+        self.sanctions.compact_periodically(self, lambda: self.compact_interval, self.feed.server_id)
+
+    @minqlx.next_frame
+    def kick_banned(self, steam_id):
+        banned = self.is_banned(steam_id)
+        if not banned:
+            return
+
+        expires, reason = banned
+        try:
+            self.kick(steam_id, "is banned until ^6{}^7: {}".format(expires, reason) if reason
+                      else "is banned until ^6{}^7.".format(expires))
+        except ValueError:
+            pass
+
     def warn_player(self, player, ratio):
         player.tell("^7You have only completed ^6{}^7 percent of your games.".format(round(ratio * 100, 1)))
         player.tell("^7If you keep leaving you ^6will^7 be banned.")
@@ -0,0 +1,352 @@
+# minqlx - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlx.
+
+# minqlx is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlx is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+"""Fetching ratings from the rating API, with a pool of worker threads that runs the most
+urgent fetches first. Used by the balance plugin."""
+
+import requests
+import itertools
+import threading
+import random
+import time
+import queue
+import heapq
+
+from collections import deque
+
+MAX_ATTEMPTS = 3
+# Timeouts in seconds for connecting to and reading from the rating API.
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+# Time in seconds a rating request is given in total, including retries.
+REQUEST_DEADLINE = 15
+# Base delay in seconds between attempts. Doubles with each attempt and gets some jitter.
+RETRY_BACKOFF = 0.5
+# Fetches are run by this many worker threads, in order of priority. A waiting fetch is moved up
+# if a more urgent request needs one of its ratings.
+FETCH_WORKERS = 2
+PRIORITY_BALANCE = 0
+PRIORITY_TEAMS = 1
+PRIORITY_RATINGS = 2
+PRIORITY_PREFETCH = 3
+PRIORITY_NAMES = ("balance", "teams", "ratings", "prefetch")
+# Consecutive failed requests before the API is left alone for BREAKER_COOLDOWN seconds.
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+# With several rating API mirrors, a request to the fastest one is duplicated to the next one if it
+# takes longer than its 90th percentile latency over the last LATENCY_SAMPLES requests. Until there
+# are enough samples for that, HEDGE_DELAY seconds is used instead.
+LATENCY_SAMPLES = 50
+MIN_LATENCY_SAMPLES = 10
+HEDGE_DELAY = 1
+# Weight of the newest latency in the moving average used to rank mirrors.
+LATENCY_SMOOTHING = 0.2
+# Upper bounds in seconds of the latency histograms shown by !balancestats.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class FetchScheduler:
+    """Runs rating fetches on a fixed number of worker threads, most urgent first. Each
+    fetch is a dict of players as taken by *run*, and a player can only be in one waiting
+    fetch at a time. A waiting fetch can be moved up with *promote*."""
+    def __init__(self, run, workers=FETCH_WORKERS):
+        self.run = run
+        self.workers = workers
+        self.threads = []
+        # Heap of [priority, sequence number, time queued, players]. The players of an entry
+        # are set to None when it's moved up, since the heap can't remove it.
+        self.queue = []
+        self.counter = itertools.count()
+        # The waiting entry of every (steam ID, game type) pair.
+        self.entries = {}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.depth = [0] * len(PRIORITY_NAMES)
+        self.started = [0] * len(PRIORITY_NAMES)
+        self.promoted = [0] * len(PRIORITY_NAMES)
+        self.total_wait = [0.0] * len(PRIORITY_NAMES)
+        self.max_wait = [0.0] * len(PRIORITY_NAMES)
+
+    def submit(self, players, priority):
+        """Queue up a fetch."""
+        with self.cond:
+            self.push([priority, next(self.counter), time.monotonic(), players])
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.cond.notify()
+
+    def promote(self, key, priority):
+        """Move the waiting fetch with the (steam ID, game type) pair *key* up to *priority*
+        if it's less urgent than that. Returns False if no waiting fetch has it."""
+        with self.cond:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            elif priority < entry[0]:
+                self.depth[entry[0]] -= 1
+                self.promoted[entry[0]] += 1
+                self.push([priority, next(self.counter), entry[2], entry[3]])
+                entry[3] = None
+            return True
+
+    def push(self, entry):
+        heapq.heappush(self.queue, entry)
+        self.depth[entry[0]] += 1
+        for key in entry[3].items():
+            self.entries[key] = entry
+
+    def work(self):
+        while True:
+            with self.cond:
+                players = None
+                while players is None:
+                    while not self.queue and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    priority, _, queued, players = heapq.heappop(self.queue)
+
+                for key in players.items():
+                    del self.entries[key]
+                wait = time.monotonic() - queued
+                self.depth[priority] -= 1
+                self.started[priority] += 1
+                self.total_wait[priority] += wait
+                self.max_wait[priority] = max(self.max_wait[priority], wait)
+
+            self.run(players)
+
+    def stats(self):
+        """Queue depth, fetches started and moved up and wait times in seconds, by priority."""
+        with self.cond:
+            return [{"queued": self.depth[i], "started": self.started[i], "promoted": self.promoted[i],
+                     "average_wait": self.total_wait[i] / self.started[i] if self.started[i] else 0,
+                     "max_wait": self.max_wait[i]} for i in range(len(PRIORITY_NAMES))]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class RatingEndpoint:
+    """A rating API mirror, along with its recent latencies and failures. Hedged requests
+    update it from several threads at once, so everything goes through the lock."""
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        # Moving average of the latency in seconds. None until a request to it finishes.
+        self.latency = None
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        # Consecutive failed requests, and until when requests are failed right away because of them.
+        self.failures = 0
+        self.open_until = 0
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+    def percentile(self, q):
+        """The *q* quantile of the recent latencies, or None if there are too few of them."""
+        with self.lock:
+            if len(self.samples) < MIN_LATENCY_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def rank(self, now):
+        """What to sort mirrors by, fewest failures and then lowest latency first, or None
+        if it has failed too many times in a row to be tried before *now*."""
+        with self.lock:
+            if now < self.open_until:
+                return None
+            return self.failures, self.latency or 0
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                # Let a single request through after the cooldown to see if it's back up.
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+
+class RatingClient:
+    """Fetches ratings from the rating API over a pool of keep-alive connections.
+
+    Every attempt has a connect and a read timeout, failed attempts are retried
+    with exponential backoff and jitter, and the whole request including retries
+    has to finish within a deadline. Failures are returned as a status code
+    instead of raised so that callers can always report back.
+
+    If there are several mirrors of the API, requests go to the fastest one that
+    isn't failing, and are duplicated to the next one if the first takes unusually
+    long to respond. Whichever answers first wins.
+
+    """
+    def __init__(self, urls, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 deadline=REQUEST_DEADLINE, attempts=MAX_ATTEMPTS, backoff=RETRY_BACKOFF, hedge_delay=HEDGE_DELAY):
+        self.endpoints = []
+        self.set_urls(urls)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.attempts = attempts
+        self.backoff = backoff
+        self.hedge_delay = hedge_delay
+        # A BalanceStats to record latencies and attempts in, if any.
+        self.stats = None
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def set_urls(self, urls):
+        """Set the mirrors to use. Takes a single URL or a list. Mirrors that were
+        already in use keep their latency statistics."""
+        if isinstance(urls, str):
+            urls = [urls]
+        known = dict((e.url, e) for e in self.endpoints)
+        self.endpoints = [known.get(url) or RatingEndpoint(url) for url in urls or ()]
+
+    def fetch(self, steam_ids, headers=None):
+        """Request the ratings of the given players. Returns a tuple with the status code
+        and the decoded response, which is None unless the status code is 200. A status
+        code of 408 means the deadline was hit, 0 that the server was unreachable and 503
+        that every mirror has failed too many times in a row to bother trying for now."""
+        now = time.monotonic()
+        mirrors = self.endpoints
+        ranks = [(e.rank(now), i) for i, e in enumerate(mirrors)]
+        endpoints = [mirrors[i] for rank, i in sorted(r for r in ranks if r[0] is not None)]
+        if not endpoints:
+            return requests.codes.service_unavailable, None
+        elif len(endpoints) == 1:
+            return self._fetch_from(endpoints[0], steam_ids, headers)
+
+        deadline = now + self.deadline
+        results = queue.Queue()
+        self._start_fetch(endpoints[0], steam_ids, headers, results)
+        hedge_delay = endpoints[0].percentile(0.9) or self.hedge_delay
+        try:
+            status, js = results.get(timeout=min(hedge_delay, self.deadline))
+            if status == requests.codes.ok:
+                return status, js
+            pending = 0
+        except queue.Empty:
+            pending = 1
+
+        # The fastest mirror is slow or failed, so we ask the next one as well.
+        self._start_fetch(endpoints[1], steam_ids, headers, results)
+        pending += 1
+        while pending:
+            try:
+                status, js = results.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return requests.codes.request_timeout, None
+            pending -= 1
+            if status == requests.codes.ok:
+                break
+
+        return status, js
+
+    def _start_fetch(self, endpoint, steam_ids, headers, results):
+        def run():
+            results.put(self._fetch_from(endpoint, steam_ids, headers))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _fetch_from(self, endpoint, steam_ids, headers):
+        status, js = self._fetch(endpoint, steam_ids, headers)
+        if status == requests.codes.ok:
+            endpoint.succeeded()
+        elif not 400 <= status < 500 or status in (requests.codes.request_timeout, requests.codes.too_many_requests):
+            endpoint.failed()
+
+        return status, js
+
+    def _fetch(self, endpoint, steam_ids, headers):
+        deadline = time.monotonic() + self.deadline
+        url = endpoint.url + "+".join([str(sid) for sid in steam_ids])
+        status = 0
+        attempts = 0
+
+        try:
+            for attempt in range(self.attempts):
+                if attempt:
+                    # Full jitter keeps servers that failed at the same time from retrying in lockstep.
+                    delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                    if time.monotonic() + delay >= deadline:
+                        return requests.codes.request_timeout, None
+                    time.sleep(delay)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return requests.codes.request_timeout, None
+
+                attempts += 1
+                start = time.monotonic()
+                try:
+                    res = self.session.get(url, headers=headers,
+                        timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)))
+                except requests.exceptions.Timeout:
+                    self._record(endpoint, time.monotonic() - start)
+                    status = requests.codes.request_timeout
+                    continue
+                except requests.exceptions.RequestException:
+                    status = 0
+                    continue
+                self._record(endpoint, time.monotonic() - start)
+
+                status = res.status_code
+                if status != requests.codes.ok:
+                    # Retrying won't fix a bad request, but it might fix an overloaded server.
+                    if 400 <= status < 500 and status not in (requests.codes.request_timeout, requests.codes.too_many_requests):
+                        return status, None
+                    continue
+
+                try:
+                    js = res.json()
+                except ValueError:
+                    js = None
+                if not isinstance(js, dict) or "players" not in js:
+                    status = -1
+                    continue
+
+                return status, js
+
+            return status, None
+        finally:
+            if self.stats:
+                self.stats.observe("http.attempts", attempts, range(1, self.attempts + 1))
+
+    def _record(self, endpoint, latency):
+        endpoint.record(latency)
+        if self.stats:
+            self.stats.observe("http.latency", latency, LATENCY_BUCKETS)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,340 @@
+# minqlx - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlx.
+
+# minqlx is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlx is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlx. If not, see <http://www.gnu.org/licenses/>.
+
+"""Bans and silences as they're stored in the database, along with keeping every
+server sharing the database up to date. Used by the ban and silence plugins."""
+
+import minqlx
+import json
+import time
+import uuid
+
+# The format older versions stored times in, in local time.
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+PLAYER_KEY = "minqlx:players:{}"
+# Bans, unbans, silences and unsilences are published here so that every server sharing the database applies them.
+SANCTIONS_CHANNEL = "minqlx:sanctions"
+# Seconds to wait before subscribing again after losing the connection.
+SUBSCRIBE_RETRY = 5
+# Set while a server compacts, or has compacted within the interval, so that servers sharing the database take turns.
+COMPACT_KEY = "minqlx:sanctions:compacted:{}"
+# Set to SANCTIONS_FORMAT once the sanctions in the database were rewritten to store epochs.
+FORMAT_KEY = "minqlx:sanctions:format:{}"
+SANCTIONS_FORMAT = 2
+# How many keys to ask SCAN for at a time when compacting or migrating, and seconds to wait between batches.
+COMPACT_BATCH = 100
+COMPACT_PAUSE = 0.1
+# Seconds between checks of whether it's time to compact.
+COMPACT_CHECK = 60
+# Sanctions are a sorted set of ids scored by expiry epoch, with a hash of details for each id.
+# Every change to them is a single script so that it takes one atomic round trip.
+# KEYS[1] is the sorted set. ARGV[1] is the expiry and the rest are the fields of the hash.
+# Returns the new id, which is the first one not in use. Compacted sanctions keep their ids in the history.
+CREATE_SANCTION = """
+local id = redis.call("ZCARD", KEYS[1]) + redis.call("LLEN", KEYS[1] .. ":history")
+while redis.call("ZSCORE", KEYS[1], id) or redis.call("EXISTS", KEYS[1] .. ":" .. id) == 1 do
+    id = id + 1
+end
+redis.call("ZADD", KEYS[1], ARGV[1], id)
+redis.call("HMSET", KEYS[1] .. ":" .. id, unpack(ARGV, 2))
+return id
+"""
+# KEYS[1] is the sorted set and ARGV[1] the current time. Sets the scores of active sanctions
+# to 0, which keeps them around but expired. Returns how many were lifted.
+LIFT_SANCTIONS = """
+local active = redis.call("ZRANGEBYSCORE", KEYS[1], ARGV[1], "+inf", "WITHSCORES")
+for i = 1, #active, 2 do
+    redis.call("ZINCRBY", KEYS[1], -tonumber(active[i + 1]), active[i])
+end
+return #active / 2
+"""
+# KEYS[1] is the sorted set and ARGV[1] the current time. Returns the id, the expiry and the
+# fields of the active sanction that expires last, all flattened into a list, or nil if none.
+LONGEST_SANCTION = """
+local res = redis.call("ZREVRANGEBYSCORE", KEYS[1], "+inf", ARGV[1], "WITHSCORES", "LIMIT", 0, 1)
+if #res == 0 then
+    return false
+end
+local fields = redis.call("HGETALL", KEYS[1] .. ":" .. res[1])
+table.insert(fields, 1, res[2])
+table.insert(fields, 1, res[1])
+return fields
+"""
+# KEYS[1] is the sorted set and ARGV[1] the current time. Moves expired sanctions into a list of JSON
+# records at KEYS[1]:history and deletes their hashes. Lifted ones are those with a score of 0.
+# Returns how many were archived and how many keys were deleted.
+COMPACT_SANCTIONS = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", "(" .. ARGV[1], "WITHSCORES")
+if #expired == 0 then
+    return {0, 0}
+end
+local deleted = 0
+for i = 1, #expired, 2 do
+    local key = KEYS[1] .. ":" .. expired[i]
+    local fields = redis.call("HGETALL", key)
+    local record = {id = tonumber(expired[i]), lifted = tonumber(expired[i + 1]) == 0}
+    for j = 1, #fields, 2 do
+        if fields[j] == "expires" or fields[j] == "issued" then
+            record[fields[j]] = tonumber(fields[j + 1]) or fields[j + 1]
+        else
+            record[fields[j]] = fields[j + 1]
+        end
+    end
+    redis.call("RPUSH", KEYS[1] .. ":history", cjson.encode(record))
+    deleted = deleted + redis.call("DEL", key)
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", "(" .. ARGV[1])
+deleted = deleted + 1 - redis.call("EXISTS", KEYS[1])
+return {#expired / 2, deleted}
+"""
+# KEYS[1] is the hash of a sanction and ARGV the fields to rewrite with their values. Only writes if the
+# hash is still there, so that a sanction compacted in the meantime doesn't leave a hash behind.
+# Returns 1 if it wrote and 0 if not.
+MIGRATE_SANCTION = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HMSET", KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
+class SanctionStore:
+    """One kind of sanction, *kind* being either "bans" or "silences". The scripts are loaded
+    into Redis on first use and called by their hash after that."""
+
+    def __init__(self, db, kind, logger):
+        self.db = db
+        self.kind = kind
+        self.logger = logger
+        self._create = db.register_script(CREATE_SANCTION)
+        self._lift = db.register_script(LIFT_SANCTIONS)
+        self._longest = db.register_script(LONGEST_SANCTION)
+        self._compact = db.register_script(COMPACT_SANCTIONS)
+        self._migrate = db.register_script(MIGRATE_SANCTION)
+
+    def key(self, steam_id):
+        return PLAYER_KEY.format(steam_id) + ":" + self.kind
+
+    def create(self, steam_id, expires, reason, issued_by):
+        """Add a sanction that lasts until the epoch *expires*. Returns its id."""
+        return self._create(keys=[self.key(steam_id)], args=[expires,
+            "expires", expires, "reason", reason, "issued", int(time.time()), "issued_by", issued_by])
+
+    def lift(self, steam_id):
+        """Lift a player's active sanctions. Returns how many there were."""
+        return self._lift(keys=[self.key(steam_id)], args=[time.time()])
+
+    def longest(self, steam_id, client=None):
+        """Get the active sanction of a player that expires last, as returned by parse_sanction.
+        With a pipeline as *client* it's only queued, and its reply has to go through parse_sanction."""
+        if client is not None:
+            self._longest(keys=[self.key(steam_id)], args=[time.time()], client=client)
+            return None
+
+        return parse_sanction(self._longest(keys=[self.key(steam_id)], args=[time.time()]))
+
+    def all_longest(self, batch=1000):
+        """Go through every player's active sanction that expires last, as (steam_id, sanction) pairs.
+        Uses SCAN and pipelines, so it's a handful of round trips per *batch* players."""
+        now = time.time()
+        keys = list(self.db.scan_iter(match=self.key("*"), count=batch))
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            db = self.db.pipeline()
+            for key in chunk:
+                self._longest(keys=[key], args=[now], client=db)
+            for key, res in zip(chunk, db.execute()):
+                sid = key.split(":")[2]
+                sanction = parse_sanction(res)
+                if sanction and sid.isdigit():
+                    yield int(sid), sanction
+
+    def claim_compaction(self, interval, owner):
+        """Whether it's our turn to compact, given it should happen every *interval* seconds."""
+        return bool(self.db.set(COMPACT_KEY.format(self.kind), owner, ex=interval, nx=True))
+
+    def compact(self, stopped=lambda: False):
+        """Move expired sanctions into each player's history and delete their hashes, along with sorted sets
+        left empty. Goes through the keys with SCAN a batch at a time so that Redis is never busy for long,
+        until done or *stopped* returns true. Returns how many were archived and how many keys were deleted."""
+        now = time.time()
+        archived = deleted = 0
+        cursor = 0
+        while True:
+            cursor, keys = self.db.scan(cursor, match=self.key("*"), count=COMPACT_BATCH)
+            if keys:
+                db = self.db.pipeline()
+                for key in keys:
+                    self._compact(keys=[key], args=[now], client=db)
+                for res in db.execute():
+                    archived += res[0]
+                    deleted += res[1]
+            if not cursor or stopped():
+                break
+            time.sleep(COMPACT_PAUSE)
+
+        self.logger.info("Compacted {}: archived {}, deleted {} keys.".format(self.kind, archived, deleted))
+        return archived, deleted
+
+    def migrate(self):
+        """Rewrite the times of sanctions stored by older versions, which were local time strings, as epochs.
+        Only needs to happen once per database, after which lookups never have to parse a time."""
+        if self.db.get(FORMAT_KEY.format(self.kind)) == str(SANCTIONS_FORMAT):
+            return
+
+        sanctions = records = 0
+        for key in self.db.scan_iter(match=self.key("*"), count=COMPACT_BATCH):
+            sanctions += migrate_sanctions(self.db, key, self._migrate)
+        for key in self.db.scan_iter(match=self.key("*") + ":history", count=COMPACT_BATCH):
+            records += migrate_history(self.db, key)
+        self.db.set(FORMAT_KEY.format(self.kind), SANCTIONS_FORMAT)
+        self.logger.info("Migrated {} to epoch times: rewrote {} and {} archived ones.".format(
+            self.kind, sanctions, records))
+
+    def compact_periodically(self, plugin, interval, owner):
+        """Compact every *interval()* seconds until *plugin* is unloaded, unless another server
+        sharing the database already did. An interval of 0 turns it off. The interval is a function
+        so that it can follow a cvar the plugin caches, since cvars can't be read from a thread.
+        Older sanctions are migrated first, so that migrating and compacting never go through
+        them at once. Blocks, so it should be called from a thread."""
+        try:
+            self.migrate()
+        except Exception:
+            minqlx.log_exception(plugin)
+
+        while not plugin.unloaded:
+            seconds = interval()
+            if seconds > 0 and self.claim_compaction(seconds, owner):
+                try:
+                    self.compact(lambda: plugin.unloaded)
+                except Exception:
+                    minqlx.log_exception(plugin)
+            time.sleep(COMPACT_CHECK)
+
+    @minqlx.thread
+    def compact_now(self, channel):
+        """Compact right away and tell *channel* how it went once it's done."""
+        archived, deleted = self.compact()
+
+        @minqlx.next_frame
+        def reply():
+            channel.reply("^7Archived ^6{}^7 expired {} and deleted ^6{}^7 keys.".format(archived, self.kind, deleted))
+        reply()
+
+
+class SanctionFeed:
+    """Sanctions published on SANCTIONS_CHANNEL, so that every server sharing the database
+    applies them right away. Our own messages are skipped, since we've already applied them."""
+
+    def __init__(self, db, types):
+        self.db = db
+        # The types of messages we're interested in.
+        self.types = types
+        self.server_id = uuid.uuid4().hex
+        self.subscribed = False
+
+    def publish(self, event_type, **data):
+        data.update(server=self.server_id, type=event_type)
+        self.db.publish(SANCTIONS_CHANNEL, json.dumps(data))
+
+    def listen(self, plugin, handle):
+        """Call *handle* with every message from another server until *plugin* is unloaded.
+        Blocks, so it should be called from a thread."""
+        while not plugin.unloaded:
+            try:
+                pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(SANCTIONS_CHANNEL)
+                self.subscribed = True
+                try:
+                    while not plugin.unloaded:
+                        message = pubsub.get_message(timeout=1)
+                        if message and message["type"] == "message":
+                            event = json.loads(message["data"])
+                            if event["server"] != self.server_id and event["type"] in self.types:
+                                handle(event)
+                finally:
+                    self.subscribed = False
+                    pubsub.close()
+            except Exception:
+                minqlx.log_exception(plugin)
+                time.sleep(SUBSCRIBE_RETRY)
+
+
+def parse_sanction(reply):
+    """Turn what LONGEST_SANCTION returns into a tuple with the id, the expiry epoch
+    and a dict with the fields of the sanction, or None if there's no active one."""
+    if not reply:
+        return None
+
+    return reply[0], float(reply[1]), dict(zip(reply[2::2], reply[3::2]))
+
+
+def epoch_fields(sanction, score=0):
+    """Get the times of a sanction that are still local time strings like older versions stored
+    them, as epochs. The expiry is taken from its *score* unless it was lifted, since that's
+    exact even across DST changes. Times that can't be read are left as they are."""
+    fields = {}
+    for field in ("expires", "issued"):
+        value = sanction.get(field)
+        if value is None:
+            continue
+        try:
+            float(value)
+        except ValueError:
+            if field == "expires" and score > 0:
+                fields[field] = int(score)
+                continue
+            try:
+                fields[field] = int(time.mktime(time.strptime(value, TIME_FORMAT)))
+            except ValueError:
+                pass
+
+    return fields
+
+
+def migrate_sanctions(db, key, rewrite):
+    """Rewrite the times of the sanctions in the sorted set at *key* as epochs, with *rewrite*
+    being the registered MIGRATE_SANCTION script. Returns how many sanctions were rewritten."""
+    sanctions = db.zrange(key, 0, -1, withscores=True)
+    pipe = db.pipeline()
+    for sanction_id, score in sanctions:
+        pipe.hmget(key + ":" + sanction_id, "expires", "issued")
+
+    updates = db.pipeline()
+    for (sanction_id, score), (expires, issued) in zip(sanctions, pipe.execute()):
+        fields = epoch_fields({"expires": expires, "issued": issued}, score)
+        if fields:
+            rewrite(keys=[key + ":" + sanction_id], args=[x for item in fields.items() for x in item], client=updates)
+    return sum(updates.execute())
+
+
+def migrate_history(db, key):
+    """Rewrite the times of the archived sanctions in the list at *key* as epochs.
+    Returns how many records were rewritten."""
+    count = 0
+    pipe = db.pipeline()
+    for i, record in enumerate(db.lrange(key, 0, -1)):
+        record = json.loads(record)
+        fields = epoch_fields(record)
+        if fields:
+            record.update(fields)
+            pipe.lset(key, i, json.dumps(record))
+            count += 1
+    pipe.execute()
+    return count
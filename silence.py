@@ -18,9 +18,15 @@
 
 import minqlx
 import datetime
+import threading
 import time
 import re
 
+try:
+    from .sanctions import SanctionStore, SanctionFeed
+except ImportError:
+    from sanctions import SanctionStore, SanctionFeed
+
 LENGTH_REGEX = re.compile(r"(?P<number>[0-9]+) (?P<scale>seconds?|minutes?|hours?|days?|weeks?|months?|years?)")
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 PLAYER_KEY = "minqlx:players:{}"
@@ -32,13 +38,47 @@ class silence(minqlx.Plugin):
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("client_command", self.handle_client_command, priority=minqlx.PRI_HIGH)
         self.add_hook("userinfo", self.handle_userinfo, priority=minqlx.PRI_HIGH)
+        self.add_hook("new_game", self.handle_new_game)
+        self.add_hook("unload", self.handle_unload)
         self.add_command("silence", self.cmd_silence, 2, usage="<id> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unsilence", self.cmd_unsilence, 2, usage="<id>")
         self.add_command("checksilence", self.cmd_checksilence, usage="<id>")
+        self.add_command("compactsilences", self.cmd_compactsilences, 5)
+
+        # Cvars.
+        self.set_cvar_once("qlx_silenceCompactInterval", "24")
+        self.cache_cvars()
 
         self.silenced = {}
 
+        # Every active silence, so that players can be checked as they load without a database call.
+        # Until it's loaded, players are checked against the database like before.
+        self.index_lock = threading.Lock()
+        self.index_ready = False
+        # Keys: steam_id - Items: (expiry epoch, reason) of their longest active silence.
+        self.silences = {}
+        # Players whose silences changed while the index was loading, to be read again once it's loaded.
+        self.index_changes = set()
+        self.sanctions = SanctionStore(self.db, "silences", self.logger)
+        self.load_index()
+
+        # Other servers sharing the database let us know about their silences through this.
+        self.feed = SanctionFeed(self.db, ("silence", "unsilence"))
+        self.unloaded = False
+        self.subscribe()
+        self.compact_periodically()
+
+    def cache_cvars(self):
+        self.compact_interval = int(self.get_cvar("qlx_silenceCompactInterval", float) * 3600)
+
     def handle_player_loaded(self, player):
+        if self.index_ready and not self.feed.subscribed:
+            # We might have missed silences from other servers, so we check the database in the background.
+            self.refresh_player(player)
+        else:
+            self.mute_silenced(player)
+
+    def mute_silenced(self, player):
         silenced = self.is_silenced(player.steam_id)
         if not silenced:
             return
@@ -55,6 +95,13 @@ class silence(minqlx.Plugin):
         if player.steam_id in self.silenced:
             del self.silenced[player.steam_id]
 
+    def handle_new_game(self):
+        self.cache_cvars()
+
+    def handle_unload(self, plugin):
+        if plugin == self.__class__.__name__:
+            self.unloaded = True
+
     def handle_client_command(self, player, cmd):
         if player.steam_id not in self.silenced:
             return
@@ -143,17 +190,11 @@ class silence(minqlx.Plugin):
             elif scale == "year":
                 td = datetime.timedelta(weeks=number * 52)
 
-            now = datetime.datetime.now().strftime(TIME_FORMAT)
-            expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
-            base_key = PLAYER_KEY.format(ident) + ":silences"
-            silence_id = self.db.zcard(base_key)
-            score = time.time() + td.total_seconds()
-            db = self.db.pipeline()
-            db.zadd(base_key, score, silence_id)
-            silence = {"expires": expires, "reason": reason, "issued": now, "issued_by": player.steam_id}
-            db.hmset(base_key + ":{}".format(silence_id), silence)
-            db.execute()
-
+            score = int(time.time() + td.total_seconds())
+            expires = datetime.datetime.fromtimestamp(score).strftime(TIME_FORMAT)
+            self.sanctions.create(ident, score, reason, player.steam_id)
+            self.index_silence(ident, score, reason)
+            self.feed.publish("silence", steam_id=ident, expires=score, reason=reason)
             if target_player:
                 self.silenced[ident] = (expires, score, reason)
                 try:
@@ -187,15 +228,13 @@ class silence(minqlx.Plugin):
         else:
             name = ident
 
-        base_key = PLAYER_KEY.format(ident) + ":silences"
-        silences = self.db.zrangebyscore(base_key, time.time(), "+inf", withscores=True)
-        if not silences:
+        if not self.sanctions.lift(ident):
             channel.reply("^7 No active silences on ^6{}^7 found.".format(name))
         else:
-            db = self.db.pipeline()
-            for silence_id, score in silences:
-                db.zincrby(base_key, silence_id, -score)
-            db.execute()
+            with self.index_lock:
+                self.silences.pop(ident, None)
+                self.index_changed(ident)
+            self.feed.publish("unsilence", steam_id=ident)
             if ident in self.silenced:
                 del self.silenced[ident]
             if target_player:
@@ -237,20 +276,118 @@ class silence(minqlx.Plugin):
 
         channel.reply("^6{} ^7is not silenced.".format(name))
 
+    def cmd_compactsilences(self, player, msg, channel):
+        """Archives expired silences right away instead of waiting for the next scheduled compaction."""
+        channel.reply("^7Compacting expired silences...")
+        self.sanctions.compact_now(channel)
+
     # ====================================================================
     #                               HELPERS
     # ====================================================================
 
+    @minqlx.thread
+    def subscribe(self):
+        """Listen for silences and unsilences made on other servers and apply them right away."""
+        self.feed.listen(self, self.handle_sanction)
+
+    @minqlx.thread
+    def compact_periodically(self):
+        """Archive expired silences every qlx_silenceCompactInterval hours."""
+        self.sanctions.compact_periodically(self, lambda: self.compact_interval, self.feed.server_id)
+
+    def index_silence(self, steam_id, expires, reason):
+        """Put a new silence in the index if it's longer than the one they already have."""
+        with self.index_lock:
+            silence = self.silences.get(steam_id)
+            if not silence or silence[0] < expires:
+                self.silences[steam_id] = (expires, reason)
+            self.index_changed(steam_id)
+
+    def index_changed(self, steam_id):
+        """Remember a player whose silences changed while the index is loading.
+        Must be called with index_lock held."""
+        if not self.index_ready:
+            self.index_changes.add(steam_id)
+
+    @minqlx.thread
+    def load_index(self):
+        """Load every active silence into memory. Uses SCAN and pipelines, so it's
+        a handful of round trips per thousand players."""
+        silences = {}
+        for sid, silence in self.sanctions.all_longest():
+            silences[sid] = (silence[1], silence[2].get("reason", ""))
+
+        with self.index_lock:
+            self.silences = silences
+
+        # What we read might be older than changes made in the meantime, so we read those players again.
+        while True:
+            with self.index_lock:
+                changed = self.index_changes
+                self.index_changes = set()
+                if not changed:
+                    self.index_ready = True
+                    return
+            for sid in changed:
+                self.read_player(sid)
+
+    @minqlx.thread
+    def refresh_player(self, player):
+        """Update a player's silence in the index from the database, and mute them
+        if it turns out another server silenced them."""
+        self.read_player(player.steam_id)
+
+        @minqlx.next_frame
+        def mute():
+            try:
+                player.update()
+            except minqlx.NonexistentPlayerError:
+                return
+            self.mute_silenced(player)
+        mute()
+
+    def read_player(self, steam_id):
+        """Read a player's silence in the index from the database."""
+        silence = self.sanctions.longest(steam_id)
+        with self.index_lock:
+            if silence:
+                self.silences[steam_id] = (silence[1], silence[2].get("reason", ""))
+            else:
+                self.silences.pop(steam_id, None)
+
+    @minqlx.next_frame
+    def handle_sanction(self, event):
+        steam_id = int(event["steam_id"])
+        player = next((p for p in self.players() if p.steam_id == steam_id), None)
+        if event["type"] == "silence":
+            # Players that aren't here are muted from the index when they load.
+            self.index_silence(steam_id, event["expires"], event["reason"] or "")
+            if not player:
+                return
+            expires = datetime.datetime.fromtimestamp(event["expires"]).strftime(TIME_FORMAT)
+            self.silenced[steam_id] = (expires, event["expires"], event["reason"] or "")
+            player.mute()
+            player.tell("You have been muted on this server until ^6{}^7.".format(expires))
+        else:
+            with self.index_lock:
+                self.silences.pop(steam_id, None)
+                self.index_changed(steam_id)
+            if steam_id in self.silenced:
+                del self.silenced[steam_id]
+                if player:
+                    player.unmute()
+
     def is_silenced(self, steam_id):
-        base_key = PLAYER_KEY.format(steam_id) + ":silences"
-        silences = self.db.zrangebyscore(base_key, time.time(), "+inf", withscores=True)
-        if not silences:
+        if self.index_ready:
+            silence = self.silences.get(steam_id)
+            if silence and silence[0] > time.time():
+                return datetime.datetime.fromtimestamp(int(silence[0])), silence[0], silence[1]
             return None
 
-        silence_id, score = silences[-1]
-        longest_silence = self.db.hgetall(base_key + ":{}".format(silence_id))
-        expires = datetime.datetime.strptime(longest_silence["expires"], TIME_FORMAT)
-        if (expires - datetime.datetime.now()).total_seconds() > 0:
-            return expires, score, longest_silence["reason"]
+        # Only silences that haven't expired yet are returned.
+        silence = self.sanctions.longest(steam_id)
+        if not silence:
+            return None
 
-        return None
+        silence_id, score, longest_silence = silence
+        return datetime.datetime.fromtimestamp(int(score)), score, longest_silence.get("reason", "")
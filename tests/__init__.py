@@ -8,10 +8,22 @@ sys.path.append(PATH + "/minqlx-plugin-tests/src/main/python")
 sys.path.append(PATH + "/minqlx-plugin-tests/src/unittest/python")
 
 from .test_balance import TestBalance
+from .test_balance_benchmark import TestBalanceBenchmark
+from .test_rating_api import TestFetchScheduler, TestRatingClient
+from .test_sanctions import TestSanctions, TestEpochFields
+from .test_ban import TestBan
+from .test_silence import TestSilence
 
 def suite():
     r = unittest.TestSuite()
     r.addTest(TestBalance())
+    r.addTest(TestBalanceBenchmark())
+    r.addTest(TestFetchScheduler())
+    r.addTest(TestRatingClient())
+    r.addTest(TestSanctions())
+    r.addTest(TestEpochFields())
+    r.addTest(TestBan())
+    r.addTest(TestSilence())
     return r
 
 
@@ -0,0 +1,67 @@
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class RatingServer(ThreadingMixIn, HTTPServer):
+    """A stand-in for the rating API on localhost. Responds to /elo/<id>+<id>... with
+    a rating for every requested steam ID, after an optional delay. The statuses
+    returned can be scripted, and requests and connections are counted."""
+    daemon_threads = True
+
+    def __init__(self, rating=1500, delay=0):
+        super().__init__(("127.0.0.1", 0), RatingHandler)
+        self.rating = rating
+        self.delay = delay
+        self.statuses = []
+        self.requests = 0
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/elo/".format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class RatingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        sids = self.path.rstrip("/").split("/")[-1].split("+")
+        body = json.dumps({
+            "players": [{"steamid": sid, "ca": {"elo": self.server.rating, "games": 10}} for sid in sids],
+            "untracked": [],
+            "playerinfo": {},
+        }).encode()
+
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,36 @@
+from unittest.mock import MagicMock, patch
+
+import json
+
+
+class SanctionPlugin:
+    """Starts the ban or silence plugin against a mock database, with the sanction scripts
+    mocked out as well and the threads that subscribe to other servers and compact never started."""
+
+    def __init__(self, plugin_class):
+        self.db = MagicMock()
+        self.patches = [
+            patch.object(plugin_class, "db", self.db, create=True),
+            patch(plugin_class.__module__ + ".SanctionStore"),
+            patch.object(plugin_class, "subscribe"),
+            patch.object(plugin_class, "compact_periodically"),
+        ]
+        for p in self.patches:
+            p.start()
+        self.plugin = plugin_class()
+
+    def stop(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def receive(self, *events):
+        """Hand *events* to the plugin as if they were published by other servers."""
+        messages = [{"type": "message", "data": json.dumps(event)} for event in events]
+
+        def get_message(timeout):
+            if messages:
+                return messages.pop(0)
+            self.plugin.unloaded = True
+
+        self.db.pubsub.return_value.get_message.side_effect = get_message
+        self.plugin.feed.listen(self.plugin, self.plugin.handle_sanction)
@@ -1,10 +1,21 @@
 from minqlx_plugin_test import setup_plugin, setup_cvar, setup_cvars, setup_game_in_progress, connected_players, fake_player, unstub, setup_game_in_warmup
 
 import unittest
+from unittest.mock import MagicMock, patch
 
-from balance import balance
+from balance import balance, best_partition, rating_difference, TeamModel, CACHE_EXPIRE, STALE_EXPIRE
+from balance import update_elo, fit_ratings, write_snapshot, read_snapshot, Rating, RatingStore
+from balance import ExpiringCache, split_differences, TeamTracker
+from rating_api import PRIORITY_BALANCE
 
-from time import time
+from time import time, perf_counter
+from itertools import combinations
+import random
+import os
+import tempfile
+
+# A server frame at the default sv_fps of 40.
+SERVER_FRAME = 0.025
 
 
 def noop(*args, **kwargs):
@@ -24,6 +35,8 @@ class TestBalance(unittest.TestCase):
         setup_plugin()
         setup_cvars({
             "qlx_balanceUseLocal": "0",
+            "qlx_balanceMaximumSuggestionSize": "3",
+            "qlx_balancePlayerInfoSize": "256",
         })
         setup_game_in_progress()
         connected_players()
@@ -34,10 +47,8 @@ class TestBalance(unittest.TestCase):
 
     def setup_balance_ratings(self, player_elos):
         gametype = self.plugin.game.type_short
-        ratings = {}
         for player, elo in player_elos:
-            ratings[player.steam_id] = {gametype: {'elo': elo, 'time': time()}}
-        self.plugin.ratings = ratings
+            self.plugin.ratings.put(player.steam_id, gametype, Rating(elo, time=time()))
 
     def test_float_suggestion_diff(self):
         eugene = fake_player(1, "eugene", "red")
@@ -88,3 +99,324 @@ class TestBalance(unittest.TestCase):
         self.plugin.handle_new_game()
 
         self.assertFalse(self.plugin.ratings)
+
+    def test_best_partition_is_optimal(self):
+        ratings = [1432, 1611, 1289, 1874, 1503, 1350, 1720, 1198, 1555, 1466]
+        total = sum(ratings)
+
+        for size in (4, 5):
+            group, diff = best_partition(ratings, size)
+            brute_force = min(
+                rating_difference(sum(ratings[i] for i in c), size, total - sum(ratings[i] for i in c), len(ratings) - size)
+                for c in combinations(range(len(ratings)), size))
+
+            self.assertEqual(len(group), size)
+            self.assertAlmostEqual(diff, brute_force)
+
+    def test_split_differences_cover_every_split(self):
+        random.seed(15)
+        ratings = [random.randint(800, 2500) for _ in range(16)]
+        diffs = split_differences(ratings, 8)
+
+        self.assertEqual(len(diffs), 12870)
+        self.assertAlmostEqual(diffs[0], best_partition(ratings, 8)[1])
+        self.assertAlmostEqual(diffs[-1], max(rating_difference(sum(c), 8, sum(ratings) - sum(c), 8)
+                                              for c in combinations(ratings, 8)))
+
+    def test_balance_is_dropped_if_teams_changed(self):
+        players = [fake_player(sid, str(sid), team) for sid, team in ((1, "red"), (2, "red"), (3, "blue"), (4, "blue"))]
+        connected_players(*players)
+        self.setup_balance_ratings(zip(players, (1000, 1100, 1200, 1300)))
+        model = self.plugin.team_model(self.plugin.teams(), self.plugin.game.type_short)
+        replies = []
+        reply_channel = FakeChannel()
+        reply_channel.reply = replies.append
+        switches = []
+        self.plugin.switch = lambda p1, p2: switches.append((p1, p2))
+
+        # Someone joined while the best split was being searched for.
+        connected_players(*players, fake_player(5, "5", "red"))
+        self.plugin.balance_teams(model, reply_channel)
+
+        self.assertFalse(switches)
+        self.assertEqual(replies, ["Teams changed while balancing. Try again."])
+
+    def test_split_report_compares_current_split(self):
+        replies = []
+        reply_channel = FakeChannel()
+        reply_channel.reply = replies.append
+        self.plugin.report_splits([1000, 1100, 1200, 1300], 2, 200, reply_channel)
+
+        self.assertEqual(len(replies), 2)
+        self.assertIn("Optimal difference: ^60^7, current split is ^6200^7 off and beaten by ^64^7 of 6 splits.",
+                      replies[0])
+
+    def test_team_tracker_places_joining_players(self):
+        tracker = TeamTracker()
+        tracker.move(1, "red", 1800)
+        tracker.move(2, "blue", 1400)
+        tracker.move(3, "red", 1600)
+        tracker.move(4, "blue", 1500)
+        tracker.move(3, "spectator", 1600)
+
+        # Blue already has more players, so red is the only option.
+        self.assertEqual(tracker.placement(1700, "red"), ("red", 0))
+        self.assertEqual(tracker.placement(1700, "blue"), ("blue", 0))
+
+        tracker.remove(4)
+        team, improvement = tracker.placement(1300, "blue")
+        self.assertEqual((team, improvement), ("red", 300))
+
+        tracker.move(5, "red", None)
+        self.assertFalse(tracker.complete())
+        tracker.remove(5)
+        self.assertTrue(tracker.complete())
+
+    def test_team_model_best_switch(self):
+        ratings = {"a": 1800, "b": 1600, "c": 1500, "d": 1200, "e": 1400, "f": 1300}
+        model = TeamModel(["a", "b", "c"], ["d", "e", "f"], ratings.get)
+
+        red_p, blue_p, diff = model.best_switch()
+        brute_force = min(model.switch_difference(ratings[r], ratings[b]) for r in "abc" for b in "def")
+        self.assertAlmostEqual(diff, brute_force)
+
+        model.switch(red_p, blue_p)
+        self.assertAlmostEqual(model.difference(), diff)
+        self.assertEqual(model.count, {"red": 3, "blue": 3})
+
+    def test_group_switch_when_no_single_switch_helps(self):
+        ratings = {"a": 1800, "b": 1800, "c": 1200, "d": 1200, "e": 1500, "f": 1500, "g": 1400, "h": 1400}
+        model = TeamModel(["a", "b", "c", "d"], ["e", "f", "g", "h"], ratings.get)
+
+        self.assertIsNone(model.best_switch())
+        red, blue, diff = model.best_group_switch(2)
+        self.assertEqual(sorted(ratings[p] for p in red), [1200, 1800])
+        self.assertEqual(sorted(ratings[p] for p in blue), [1400, 1500])
+        self.assertEqual(diff, 0)
+
+    def test_group_switch_search_fits_in_a_frame(self):
+        rng = random.Random(8)
+        ratings = {i: rng.gauss(1500, 250) for i in range(16)}
+
+        start = perf_counter()
+        for _ in range(10):
+            model = TeamModel(range(8), range(8, 16), ratings.get)
+            for size in range(1, 4):
+                model.best_group_switch(size)
+        elapsed = (perf_counter() - start) / 10
+
+        self.assertLess(elapsed, SERVER_FRAME)
+
+    def test_concurrent_requests_share_a_fetch(self):
+        fetched = []
+        finished = []
+        self.plugin.scheduler.submit = lambda players, priority: fetched.append(players)
+        self.plugin.handle_ratings_fetched = lambda request_id, status_code: finished.append(request_id)
+
+        self.plugin.add_request({1: "ca", 2: "ca"}, noop, channel)
+        self.plugin.add_request({2: "ca", 3: "ca"}, noop, channel)
+        self.plugin.batch_timer.cancel()
+        self.plugin.flush_batch()
+
+        self.assertEqual(fetched, [{1: "ca", 2: "ca", 3: "ca"}])
+        self.assertFalse(finished)
+
+        self.plugin.finish_fetch({(1, "ca"), (2, "ca"), (3, "ca")}, 200)
+        self.assertEqual(sorted(finished), [0, 1])
+
+    def test_prefetch_collapses_into_one_fetch(self):
+        gt = self.plugin.game.type_short
+        fetched = []
+        self.plugin.scheduler.submit = lambda players, priority: fetched.append(players)
+
+        for sid in (10, 11, 12):
+            self.plugin.prefetch({sid: gt})
+        self.plugin.prefetch_timer.cancel()
+        self.plugin.flush_batch(True)
+        self.assertEqual(fetched, [{10: gt, 11: gt, 12: gt}])
+
+        self.plugin.finish_fetch({(10, gt), (11, gt), (12, gt)}, 200)
+        self.setup_balance_ratings([(fake_player(sid, str(sid)), 1500) for sid in (10, 11, 12)])
+        self.plugin.add_request({10: gt, 11: gt, 12: gt}, noop, channel)
+        self.assertEqual(self.plugin.prefetch_hit_ratio(), 1)
+
+    def test_callbacks_only_fetch_players_that_joined(self):
+        gt = self.plugin.game.type_short
+        players = [fake_player(sid, str(sid), team) for sid, team in ((1, "red"), (2, "blue"), (3, "red"))]
+        requested = []
+        self.plugin.add_request = lambda players, callback, channel, *args, **kwargs: requested.append((players, args))
+
+        self.assertTrue(self.plugin.fetch_missing({1: gt, 2: gt}, players, noop, channel, 0))
+        self.assertEqual(requested, [({3: gt}, ({1: gt, 2: gt}, noop, 1))])
+
+        self.assertTrue(self.plugin.fetch_missing({1: gt, 2: gt}, players, noop, channel, 3))
+        self.assertEqual(len(requested), 1)
+        self.assertFalse(self.plugin.fetch_missing({1: gt, 2: gt, 3: gt}, players, noop, channel, 0))
+
+    def test_urgent_requests_move_up_prefetches(self):
+        gt = self.plugin.game.type_short
+        promoted = []
+        self.plugin.scheduler.submit = lambda players, priority: None
+        self.plugin.scheduler.promote = lambda key, priority: promoted.append((key, priority))
+
+        self.plugin.prefetch({10: gt})
+        self.plugin.prefetch_timer.cancel()
+        self.plugin.flush_batch(True)
+        self.plugin.add_request({10: gt}, noop, channel, priority=PRIORITY_BALANCE)
+
+        self.assertIsNone(self.plugin.batch_timer)
+        self.assertEqual(promoted, [((10, gt), PRIORITY_BALANCE)])
+
+    def test_stale_ratings_are_served_and_refreshed(self):
+        player = fake_player(1, "Evmoncer", "red")
+        gt = self.plugin.game.type_short
+        self.plugin.ratings.put(player.steam_id, gt, Rating(1443, time=time() - CACHE_EXPIRE - 1))
+
+        stale = set()
+        self.assertFalse(self.plugin.remove_cached({player.steam_id: gt}, stale))
+        self.assertEqual(stale, {(player.steam_id, gt)})
+        self.assertTrue(self.plugin.remove_cached({player.steam_id: gt}))
+
+    def test_failed_fetches_are_not_ratings(self):
+        gt = self.plugin.game.type_short
+        replies = []
+        called = []
+        reply_channel = FakeChannel()
+        reply_channel.reply = replies.append
+        self.plugin.ratings.put(1, gt, Rating(1443, time=time() - STALE_EXPIRE - 1))
+        self.plugin.ratings.put(2, gt, Rating(1500, time=time(), negative=True))
+
+        # A player a fetch just failed for isn't fetched again, and has no rating to use.
+        self.assertEqual(self.plugin.remove_cached({2: gt}), {})
+        self.assertIsNone(self.plugin.cached_elo(2, gt))
+        self.plugin.add_request({1: gt, 2: gt}, lambda *args: called.append(args), reply_channel)
+        self.plugin.batch_timer.cancel()
+        self.plugin.finish_fetch({(1, gt)}, 200)
+        self.assertFalse(called)
+        self.assertTrue(replies[-1].startswith("ERROR"))
+
+        # Players with an earlier rating fall back on it.
+        self.plugin.ratings.put(1, gt, Rating(1443, time=time() - STALE_EXPIRE - 1))
+        self.plugin.add_request({1: gt}, lambda *args: called.append(args), reply_channel)
+        self.plugin.finish_fetch({(1, gt)}, 503)
+        self.assertEqual(len(called), 1)
+        self.assertTrue(replies[-1].startswith("WARNING"))
+
+    def test_local_ratings_set_while_loading_are_kept(self):
+        db = MagicMock()
+        db.scan_iter.return_value = ["minqlx:players:1:ratings:ca", "minqlx:players:2:ratings:ca"]
+
+        # Both players' ratings change after they were read, but before the index is swapped in.
+        def mget(keys):
+            self.plugin.update_local_index(1, "ca", 1700)
+            self.plugin.update_local_index(2, "ca", None)
+            return ["1600", "1400"]
+
+        db.mget.side_effect = mget
+        self.plugin.local_changes = {}
+        with patch.object(balance, "db", db, create=True):
+            self.plugin.load_local_ratings()
+
+        self.assertEqual(self.plugin.local_ratings, {(1, "ca"): 1700})
+        self.assertIsNone(self.plugin.local_changes)
+
+    def test_unload_stops_timers(self):
+        self.plugin.scheduler.submit = noop
+        self.plugin.save_snapshot = noop
+        self.plugin.add_request({1: "ca"}, noop, channel)
+        self.plugin.prefetch({2: "ca"})
+        timers = [self.plugin.batch_timer, self.plugin.prefetch_timer, self.plugin.snapshot_timer]
+
+        self.plugin.handle_unload("balance")
+        self.assertTrue(all(timer.finished.is_set() for timer in timers))
+
+        # A snapshot that was already being saved doesn't schedule another one.
+        self.plugin.periodic_snapshot()
+        self.assertIs(self.plugin.snapshot_timer, timers[2])
+
+    def test_local_elo_update(self):
+        ratings = update_elo({1: 1500, 2: 1500, 3: 1600, 4: 1400}, {1: 50, 2: 50, 3: 50, 4: 50}, [1, 2], [3, 4], 1)
+
+        self.assertEqual(ratings, {1: 1508, 2: 1508, 3: 1592, 4: 1392})
+
+    def test_fit_ratings_orders_players_by_results(self):
+        # 1 always beats 2, who always beats 3.
+        matches = [([1], [2], 1), ([2], [3], 1), ([1], [3], 1)] * 5
+        ratings = fit_ratings(matches)
+
+        self.assertGreater(ratings[1], ratings[2])
+        self.assertGreater(ratings[2], ratings[3])
+
+    def test_snapshot_round_trip(self):
+        ratings = {
+            (76561198000000001, "ca"): Rating(1612, 33, time()),
+            (76561198000000002, "ffa"): Rating(17.5, -1, time()),
+        }
+
+        with tempfile.TemporaryDirectory() as home:
+            path = os.path.join(home, "ratings.bin")
+            write_snapshot(path, ratings)
+            self.assertEqual(read_snapshot(path), ratings)
+            self.assertFalse(os.path.exists(path + ".tmp"))
+
+            with open(path, "r+b") as f:
+                f.seek(-1, os.SEEK_END)
+                f.write(b"x")
+            self.assertRaises(ValueError, read_snapshot, path)
+
+
+    def test_rating_store_drops_least_recently_used(self):
+        store = RatingStore(max_players=2)
+        store.put(1, "ca", Rating(1500))
+        store.put(2, "ca", Rating(1600))
+        store.get(1, "ca")
+        store.put(3, "ca", Rating(1700))
+
+        self.assertIn(1, store)
+        self.assertNotIn(2, store)
+        self.assertEqual(store.get(3, "ca").elo, 1700)
+        self.assertIsNone(store.get(3, "ffa"))
+
+        store.expire(1, "ca")
+        self.assertIsNone(store.get(1, "ca"))
+        store.expire(3)
+        self.assertNotIn(3, store)
+
+    def test_rating_store_put_missing_keeps_ratings(self):
+        store = RatingStore()
+        store.put(1, "ca", Rating(1500))
+        store.put_missing(1, "ca", Rating(1200, negative=True))
+        store.put_missing(2, "ca", Rating(1200, negative=True))
+
+        self.assertEqual(store.get(1, "ca").elo, 1500)
+        self.assertTrue(store.get(2, "ca").negative)
+
+    def test_expiring_cache_counts_hits_misses_and_evictions(self):
+        cache = ExpiringCache(2, 60)
+        cache.put(1, "a")
+        cache.put(2, "b")
+        self.assertEqual(cache.get(1), "a")
+        cache.put(3, "c")
+
+        self.assertIsNone(cache.get(2))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 1))
+
+        cache.ttl = 0
+        self.assertIsNone(cache.get(3))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_getrating_looks_up_player_info(self):
+        replies = []
+        reply_channel = FakeChannel()
+        reply_channel.reply = replies.append
+        self.setup_balance_ratings([(fake_player(1, "Evmoncer"), 1443), (fake_player(2, "FalseMan"), 1394)])
+        self.plugin.player_info.put(1, {"privacy": "private"})
+        self.plugin.player = noop
+
+        self.plugin.callback_getrating({1: "ca"}, reply_channel, "ca")
+        self.plugin.callback_getrating({2: "ca"}, reply_channel, "ca")
+
+        self.assertEqual(replies[1], "Their rating profile is ^6private^7.")
+        self.assertEqual(len(replies), 3)
+        self.assertEqual((self.plugin.player_info.hits, self.plugin.player_info.misses), (1, 1))
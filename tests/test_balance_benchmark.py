@@ -0,0 +1,160 @@
+from minqlx_plugin_test import setup_plugin, setup_cvars, setup_game_in_progress, connected_players, fake_player, unstub
+
+import unittest
+
+from balance import balance, Rating, TeamModel
+
+from time import time, perf_counter
+import json
+import os
+import random
+import sys
+
+# Stored results to compare against. Set BALANCE_BENCHMARK_UPDATE=1 to write new ones.
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "balance_benchmark.json")
+# Timings depend on the machine, so they're only compared to the baseline if BALANCE_BENCHMARK_TIMING is set.
+CHECK_TIMING = bool(os.environ.get("BALANCE_BENCHMARK_TIMING"))
+# How much slower than the baseline a benchmark may run before it fails, to allow for slower machines.
+TIME_TOLERANCE = 3
+# Timings below this many seconds are too noisy to compare.
+TIME_FLOOR = 0.002
+TEAM_SIZES = (2, 4, 6, 8, 10, 12, 16)
+
+
+def noop(*args, **kwargs):
+    return None
+
+
+class FakeChannel:
+    reply = noop
+
+
+channel = FakeChannel()
+
+
+def lobby_ratings(size, seed):
+    """Ratings of a lobby with *size* players on each team. Most players are spread around
+    the usual qlstats range, with a few at the default rating like new players would be."""
+    rng = random.Random(seed)
+    return [1500 if rng.random() < 0.1 else min(2800, max(600, round(rng.gauss(1450, 280))))
+            for _ in range(2 * size)]
+
+
+class TestBalanceBenchmark(unittest.TestCase):
+    """Measures the balancing code on synthetic lobbies and fails if it balances worse than
+    the results stored in BASELINE_FILE, or got slower if CHECK_TIMING is set. The timings
+    are always reported. Doesn't use the network."""
+    results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        for name in sorted(cls.results):
+            result = cls.results[name]
+            sys.stderr.write("\n{:<24} {:>10.3f} ms {:>3} switches {:>8.2f} diff".format(
+                name, 1000 * result["time"], result.get("switches", 0), result.get("difference", 0)))
+        sys.stderr.write("\n")
+
+        if os.environ.get("BALANCE_BENCHMARK_UPDATE"):
+            with open(BASELINE_FILE, "w") as f:
+                json.dump(cls.results, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+    def setUp(self):
+        setup_plugin()
+        setup_cvars({
+            "qlx_balanceUseLocal": "0",
+            "qlx_balanceMaximumSuggestionSize": "3",
+            "qlx_balancePlayerInfoSize": "256",
+        })
+        setup_game_in_progress()
+        connected_players()
+        self.plugin = balance()
+        self.plugin.msg = noop
+        self.baseline = {}
+        if os.path.isfile(BASELINE_FILE):
+            with open(BASELINE_FILE) as f:
+                self.baseline = json.load(f)
+
+    def tearDown(self):
+        unstub()
+
+    def setup_lobby(self, size):
+        gt = self.plugin.game.type_short
+        ratings = lobby_ratings(size, size)
+        players = [fake_player(i + 1, "player{}".format(i + 1), "red" if i < size else "blue")
+                   for i in range(2 * size)]
+        connected_players(*players)
+        for p, rating in zip(players, ratings):
+            self.plugin.ratings.put(p.steam_id, gt, Rating(rating, time=time()))
+
+        return {"red": players[:size], "blue": players[size:]}, dict((p.steam_id, gt) for p in players)
+
+    def measure(self, name, func, repeat):
+        """Time the fastest of *repeat* runs of *func*, which is the least noisy, and check what
+        was recorded against the baseline. The time is only checked if CHECK_TIMING is set."""
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            func()
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        result = self.results.setdefault(name, {})
+        result["time"] = round(best, 6)
+
+        baseline = self.baseline.get(name)
+        if baseline:
+            if CHECK_TIMING:
+                self.assertLessEqual(best, max(TIME_FLOOR, baseline["time"] * TIME_TOLERANCE),
+                                     "{} got slower".format(name))
+            self.assertLessEqual(result.get("difference", 0), baseline.get("difference", 0) + 1e-6,
+                                 "{} balances worse".format(name))
+            self.assertLessEqual(result.get("switches", 0), baseline.get("switches", 0),
+                                 "{} switches more players".format(name))
+
+    def test_suggest_switch(self):
+        gt = self.plugin.game.type_short
+        for size in TEAM_SIZES:
+            teams, _ = self.setup_lobby(size)
+            name = "suggest_switch {}v{}".format(size, size)
+            switch = self.plugin.suggest_switch(teams, gt, 3)
+            model = self.plugin.team_model(teams, gt)
+            if switch:
+                red, blue = switch[0]
+                self.results[name] = {"switches": len(red),
+                                      "difference": model.difference() - switch[1]}
+            else:
+                self.results[name] = {"switches": 0, "difference": model.difference()}
+
+            self.measure(name, lambda: self.plugin.suggest_switch(teams, gt, 3), 20)
+
+    def test_team_average(self):
+        gt = self.plugin.game.type_short
+        for size in TEAM_SIZES:
+            teams, _ = self.setup_lobby(size)
+            self.measure("team_average {}v{}".format(size, size),
+                         lambda: self.plugin.team_average(teams["red"], gt), 200)
+
+    def test_remove_cached(self):
+        for size in TEAM_SIZES:
+            _, players = self.setup_lobby(size)
+            self.measure("remove_cached {}v{}".format(size, size),
+                         lambda: self.plugin.remove_cached(players.copy(), set()), 200)
+
+    def test_callback_balance(self):
+        gt = self.plugin.game.type_short
+        for size in TEAM_SIZES:
+            teams, players = self.setup_lobby(size)
+            switches = []
+            self.plugin.switch = lambda p1, p2: switches.append((p1, p2))
+            self.plugin.callback_balance(players, channel)
+
+            # Apply the switches it did to see where it left the teams.
+            model = TeamModel(teams["red"], teams["blue"],
+                              lambda p: self.plugin.ratings.get(p.steam_id, gt).elo)
+            for p1, p2 in switches:
+                model.switch(p1, p2)
+
+            name = "callback_balance {}v{}".format(size, size)
+            self.results[name] = {"switches": len(switches), "difference": model.difference()}
+            self.measure(name, lambda: self.plugin.callback_balance(players, channel), 3)
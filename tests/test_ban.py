@@ -0,0 +1,140 @@
+from minqlx_plugin_test import setup_plugin, setup_cvars, connected_players, fake_player, unstub
+
+import unittest
+from unittest.mock import MagicMock
+
+from ban import ban
+
+from .sanction_plugin import SanctionPlugin
+
+from time import time
+
+STEAM_ID = 76561198000000001
+
+
+def noop(*args, **kwargs):
+    return None
+
+
+class FakeChannel:
+    reply = noop
+
+
+channel = FakeChannel()
+
+
+class TestBan(unittest.TestCase):
+
+    def setUp(self):
+        setup_plugin()
+        setup_cvars({
+            "qlx_leaverBan": "1",
+            "qlx_leaverBanThreshold": "0.63",
+            "qlx_leaverBanWarnThreshold": "0.78",
+            "qlx_leaverBanMinimumGames": "15",
+            "qlx_banCompactInterval": "24",
+        })
+        connected_players()
+        self.fixture = SanctionPlugin(ban)
+        self.db = self.fixture.db
+        self.plugin = self.fixture.plugin
+        self.plugin.kick = MagicMock()
+        self.sanctions = self.plugin.sanctions
+
+    def tearDown(self):
+        self.fixture.stop()
+        unstub()
+
+    def test_index_is_loaded(self):
+        self.assertTrue(self.plugin.index_ready)
+        self.assertEqual(self.plugin.bans, {})
+        self.assertEqual(self.plugin.leaves, {})
+
+    def test_connect_is_checked_against_index(self):
+        self.plugin.index_ban(STEAM_ID, time() + 3600, "spam")
+        self.plugin.index_leaves({STEAM_ID + 1: 5}, {STEAM_ID + 1: 20})
+        self.plugin.feed.subscribed = True
+        self.db.reset_mock()
+        self.sanctions.reset_mock()
+
+        self.assertIn("spam", self.plugin.handle_player_connect(fake_player(STEAM_ID, "Evmoncer")))
+        self.assertIn("leaving", self.plugin.handle_player_connect(fake_player(STEAM_ID + 1, "FalseMan")))
+        self.assertIsNone(self.plugin.handle_player_connect(fake_player(STEAM_ID + 2, "Mino")))
+        self.assertEqual(self.db.mock_calls, [])
+        self.assertEqual(self.sanctions.mock_calls, [])
+
+    def test_expired_bans_in_index_are_ignored(self):
+        self.plugin.index_ban(STEAM_ID, time() - 1, "spam")
+        self.plugin.feed.subscribed = True
+
+        self.assertIsNone(self.plugin.handle_player_connect(fake_player(STEAM_ID, "Evmoncer")))
+
+    def test_ban_while_loading_is_picked_up(self):
+        expires = int(time() + 86400)
+
+        # The ban is made after the bans were read, but before the index is swapped in.
+        def all_longest():
+            self.plugin.cmd_ban(fake_player(1, "Mino"), ["!ban", str(STEAM_ID), "1", "day", "spam"], channel)
+            return iter(())
+
+        self.sanctions.all_longest.side_effect = all_longest
+        self.db.has_permission.return_value = False
+        self.db.pipeline.return_value.execute.return_value = [["0", str(expires), "reason", "spam"], "5", "20"]
+        self.plugin.reload_index()
+
+        self.assertTrue(self.plugin.index_ready)
+        self.sanctions.longest.assert_called_once_with(STEAM_ID, client=self.db.pipeline.return_value)
+        self.assertEqual(self.plugin.bans, {STEAM_ID: (expires, "spam")})
+        self.assertEqual(self.plugin.leaves, {STEAM_ID: [5, 20]})
+        self.assertFalse(self.plugin.index_changes)
+
+    def test_ban_from_another_server_kicks_player(self):
+        expires = int(time() + 3600)
+        self.fixture.receive({"server": "other", "type": "ban", "steam_id": STEAM_ID, "expires": expires, "reason": "spam"})
+
+        self.assertEqual(self.plugin.bans, {STEAM_ID: (expires, "spam")})
+        self.plugin.kick.assert_called_once()
+        steam_id, reason = self.plugin.kick.call_args[0]
+        self.assertEqual(steam_id, STEAM_ID)
+        self.assertIn("spam", reason)
+
+    def test_unban_from_another_server(self):
+        self.plugin.index_ban(STEAM_ID, time() + 3600, "spam")
+        self.fixture.receive({"server": "other", "type": "unban", "steam_id": STEAM_ID})
+
+        self.assertEqual(self.plugin.bans, {})
+        self.plugin.feed.subscribed = True
+        self.assertIsNone(self.plugin.handle_player_connect(fake_player(STEAM_ID, "Evmoncer")))
+        self.plugin.kick.assert_not_called()
+
+    def test_leaves_from_another_server(self):
+        self.fixture.receive({"server": "other", "type": "leaves", "completed": {str(STEAM_ID): 5}, "left": {}},
+                             {"server": "other", "type": "leaves", "completed": {}, "left": {str(STEAM_ID): 20}})
+
+        self.assertEqual(self.plugin.leaves, {STEAM_ID: [5, 20]})
+
+    def test_own_and_unknown_messages_are_skipped(self):
+        self.fixture.receive({"server": self.plugin.feed.server_id, "type": "ban", "steam_id": STEAM_ID,
+                              "expires": time() + 3600, "reason": ""},
+                             {"server": "other", "type": "silence", "steam_id": STEAM_ID, "expires": time() + 3600,
+                              "reason": ""})
+
+        self.assertEqual(self.plugin.bans, {})
+        self.plugin.kick.assert_not_called()
+
+    def test_leaves_are_not_loaded_without_leaver_ban(self):
+        setup_cvars({
+            "qlx_leaverBan": "0",
+            "qlx_leaverBanThreshold": "0.63",
+            "qlx_leaverBanWarnThreshold": "0.78",
+            "qlx_leaverBanMinimumGames": "15",
+            "qlx_banCompactInterval": "24",
+        })
+        self.plugin.handle_new_game()
+        self.db.reset_mock()
+        self.plugin.reload_index()
+
+        self.assertTrue(self.plugin.index_ready)
+        self.db.scan_iter.assert_not_called()
+        self.plugin.index_leaves({}, {STEAM_ID: 20})
+        self.assertEqual(self.plugin.leaves, {})
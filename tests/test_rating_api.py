@@ -0,0 +1,165 @@
+import unittest
+
+from rating_api import RatingClient, FetchScheduler, BREAKER_THRESHOLD, PRIORITY_BALANCE, PRIORITY_RATINGS, \
+    PRIORITY_PREFETCH
+from balance import BalanceStats
+
+from .rating_server import RatingServer
+
+from time import perf_counter, sleep
+import threading
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+    def test_fetch_scheduler_runs_urgent_fetches_first(self):
+        ran = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def run(players):
+            started.set()
+            release.wait(1)
+            ran.append(players)
+
+        scheduler = FetchScheduler(run, workers=1)
+        scheduler.submit({1: "ca"}, PRIORITY_RATINGS)
+        started.wait(1)
+        scheduler.submit({2: "ca"}, PRIORITY_RATINGS)
+        scheduler.submit({3: "ca"}, PRIORITY_BALANCE)
+        self.assertEqual(scheduler.stats()[PRIORITY_RATINGS]["queued"], 1)
+
+        release.set()
+        for _ in range(20):
+            if len(ran) == 3:
+                break
+            sleep(0.05)
+        scheduler.close()
+
+        self.assertEqual(ran, [{1: "ca"}, {3: "ca"}, {2: "ca"}])
+
+    def test_fetch_scheduler_moves_up_waiting_fetches(self):
+        ran = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def run(players):
+            started.set()
+            release.wait(1)
+            ran.append(players)
+
+        scheduler = FetchScheduler(run, workers=1)
+        scheduler.submit({1: "ca"}, PRIORITY_RATINGS)
+        started.wait(1)
+        scheduler.submit({2: "ca", 3: "ca"}, PRIORITY_PREFETCH)
+        scheduler.submit({4: "ca"}, PRIORITY_RATINGS)
+        self.assertTrue(scheduler.promote((3, "ca"), PRIORITY_BALANCE))
+        self.assertTrue(scheduler.promote((4, "ca"), PRIORITY_PREFETCH))
+        self.assertFalse(scheduler.promote((1, "ca"), PRIORITY_BALANCE))
+        self.assertEqual([stats["queued"] for stats in scheduler.stats()], [1, 0, 1, 0])
+
+        release.set()
+        for _ in range(20):
+            if len(ran) == 3:
+                break
+            sleep(0.05)
+        scheduler.close()
+
+        self.assertEqual(ran, [{1: "ca"}, {2: "ca", 3: "ca"}, {4: "ca"}])
+        self.assertEqual(scheduler.stats()[PRIORITY_PREFETCH]["promoted"], 1)
+        self.assertEqual(scheduler.stats()[PRIORITY_BALANCE]["started"], 1)
+
+
+class TestRatingClient(unittest.TestCase):
+
+    def test_fetch_reuses_connections(self):
+        with RatingServer() as server:
+            client = RatingClient(server.url)
+            for _ in range(3):
+                status, js = client.fetch([1, 2])
+                self.assertEqual(status, 200)
+                self.assertEqual([p["steamid"] for p in js["players"]], ["1", "2"])
+            client.close()
+
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(server.connections, 1)
+
+    def test_fetch_retries_server_errors(self):
+        with RatingServer() as server:
+            server.statuses = [503, 502]
+            client = RatingClient(server.url, backoff=0.01)
+            status, js = client.fetch([1])
+            client.close()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(server.requests, 3)
+
+    def test_fetch_times_out(self):
+        with RatingServer(delay=0.5) as server:
+            client = RatingClient(server.url, read_timeout=0.1, backoff=0.01)
+            start = perf_counter()
+            status, js = client.fetch([1])
+            elapsed = perf_counter() - start
+            client.close()
+
+        self.assertEqual(status, 408)
+        self.assertIsNone(js)
+        self.assertEqual(server.requests, 3)
+        self.assertLess(elapsed, 0.5)
+
+    def test_fetch_gives_up_at_deadline(self):
+        with RatingServer(delay=0.5) as server:
+            client = RatingClient(server.url, read_timeout=10, deadline=0.2)
+            start = perf_counter()
+            status, js = client.fetch([1])
+            elapsed = perf_counter() - start
+            client.close()
+
+        self.assertEqual(status, 408)
+        self.assertLess(elapsed, 0.4)
+
+    def test_fetch_fails_fast_after_repeated_failures(self):
+        with RatingServer() as server:
+            server.statuses = [500] * BREAKER_THRESHOLD
+            client = RatingClient(server.url, attempts=1)
+            for _ in range(BREAKER_THRESHOLD):
+                client.fetch([1])
+            status, js = client.fetch([1])
+            client.close()
+
+        self.assertEqual(status, 503)
+        self.assertEqual(server.requests, BREAKER_THRESHOLD)
+
+    def test_fetch_records_attempts_and_latency(self):
+        stats = BalanceStats()
+        with RatingServer() as server:
+            server.statuses = [503]
+            client = RatingClient(server.url, backoff=0.01)
+            client.stats = stats
+            client.fetch([1])
+            client.close()
+
+        histograms = stats.export()["histograms"]
+        self.assertEqual(histograms["http.attempts"]["buckets"][:3], [[1, 0], [2, 1], [3, 0]])
+        self.assertEqual(histograms["http.latency"]["count"], 2)
+
+    def test_fetch_hedges_to_second_mirror(self):
+        with RatingServer(delay=0.5) as slow, RatingServer() as fast:
+            client = RatingClient([slow.url, fast.url], hedge_delay=0.05)
+            start = perf_counter()
+            status, js = client.fetch([1])
+            elapsed = perf_counter() - start
+            self.assertEqual(status, 200)
+            self.assertLess(elapsed, 0.4)
+
+            # Once the slow mirror has answered, the fast one is tried first.
+            for _ in range(20):
+                if client.endpoints[0].latency is not None:
+                    break
+                sleep(0.05)
+            status, js = client.fetch([1])
+            client.close()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(slow.requests, 1)
+        self.assertEqual(fast.requests, 2)
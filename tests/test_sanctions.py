@@ -0,0 +1,193 @@
+import unittest
+
+from sanctions import CREATE_SANCTION, LIFT_SANCTIONS, LONGEST_SANCTION, COMPACT_SANCTIONS, MIGRATE_SANCTION, \
+    TIME_FORMAT, parse_sanction, epoch_fields, migrate_sanctions, migrate_history
+
+from threading import Thread
+from time import time, localtime, strftime
+import json
+import os
+import uuid
+
+import redis
+
+# The scripts are run against a real server, which is skipped if there's none to connect to.
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_DB = int(os.environ.get("REDIS_DB", 15))
+
+
+class TestSanctions(unittest.TestCase):
+    """Runs the sanction scripts shared by the ban and silence plugins against a local Redis.
+    Everything is written under a random prefix that's deleted afterwards."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = redis.StrictRedis(REDIS_HOST, REDIS_PORT, REDIS_DB, decode_responses=True)
+        try:
+            cls.db.ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest("no Redis server at {}:{}".format(REDIS_HOST, REDIS_PORT))
+
+    def setUp(self):
+        self.prefix = "test:{}".format(uuid.uuid4().hex)
+        self.key = self.prefix + ":bans"
+        self.create = self.db.register_script(CREATE_SANCTION)
+        self.lift = self.db.register_script(LIFT_SANCTIONS)
+        self.longest = self.db.register_script(LONGEST_SANCTION)
+
+    def tearDown(self):
+        keys = list(self.db.scan_iter(self.prefix + ":*"))
+        if keys:
+            self.db.delete(*keys)
+
+    def add(self, expires, reason=""):
+        return self.create(keys=[self.key], args=[expires, "reason", reason])
+
+    def test_create_sanction(self):
+        self.assertEqual(self.add(time() + 60, "spam"), 0)
+        self.assertEqual(self.add(time() + 120), 1)
+        self.assertEqual(self.db.zcard(self.key), 2)
+        self.assertEqual(self.db.hgetall(self.key + ":0"), {"reason": "spam"})
+
+    def test_create_sanction_skips_used_ids(self):
+        # With an earlier sanction gone from the sorted set but not its details, the count
+        # of the set is an id that's taken.
+        self.add(time() + 60)
+        self.add(time() + 60)
+        self.db.zrem(self.key, 0)
+        self.assertEqual(self.add(time() + 60, "new"), 2)
+        self.assertEqual(self.db.hgetall(self.key + ":1"), {"reason": ""})
+
+    def test_create_sanction_concurrently(self):
+        ids = []
+
+        def create():
+            db = redis.StrictRedis(REDIS_HOST, REDIS_PORT, REDIS_DB, decode_responses=True)
+            for _ in range(20):
+                ids.append(self.create(keys=[self.key], args=[time() + 60, "reason", ""], client=db))
+
+        threads = [Thread(target=create) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(ids), list(range(100)))
+        self.assertEqual(self.db.zcard(self.key), 100)
+
+    def test_lift_sanctions(self):
+        self.add(time() - 60)
+        self.add(time() + 60)
+        self.add(time() + 120)
+        self.assertEqual(self.lift(keys=[self.key], args=[time()]), 2)
+        self.assertEqual(self.db.zcount(self.key, time(), "+inf"), 0)
+        self.assertEqual(self.db.zcard(self.key), 3)
+        self.assertEqual(self.lift(keys=[self.key], args=[time()]), 0)
+
+    def test_longest_sanction(self):
+        self.assertIsNone(parse_sanction(self.longest(keys=[self.key], args=[time()])))
+        expires = round(time() + 120)
+        self.add(time() - 60, "old")
+        self.add(expires, "long")
+        self.add(time() + 60, "short")
+
+        sanction_id, score, fields = parse_sanction(self.longest(keys=[self.key], args=[time()]))
+        self.assertEqual(sanction_id, "1")
+        self.assertEqual(score, expires)
+        self.assertEqual(fields, {"reason": "long"})
+
+    def test_longest_sanction_pipelined(self):
+        self.add(time() + 60, "spam")
+        db = self.db.pipeline()
+        self.longest(keys=[self.key], args=[time()], client=db)
+        self.longest(keys=[self.prefix + ":silences"], args=[time()], client=db)
+        found, missing = db.execute()
+        self.assertEqual(parse_sanction(found)[2], {"reason": "spam"})
+        self.assertIsNone(parse_sanction(missing))
+
+    def test_compact_sanctions(self):
+        compact = self.db.register_script(COMPACT_SANCTIONS)
+        self.add(time() - 120, "old")
+        self.add(time() + 60, "lifted")
+        self.lift(keys=[self.key], args=[time()])
+        self.add(time() + 60, "active")
+
+        self.assertEqual(compact(keys=[self.key], args=[time()]), [2, 2])
+        self.assertEqual(self.db.zrange(self.key, 0, -1), ["2"])
+        self.assertFalse(self.db.exists(self.key + ":0"))
+        self.assertFalse(self.db.exists(self.key + ":1"))
+        history = [json.loads(record) for record in self.db.lrange(self.key + ":history", 0, -1)]
+        self.assertEqual(sorted(history, key=lambda record: record["id"]),
+                         [{"id": 0, "lifted": False, "reason": "old"}, {"id": 1, "lifted": True, "reason": "lifted"}])
+
+        # Ids carry on from the ones in the history.
+        self.assertEqual(self.add(time() + 60), 3)
+        self.assertEqual(compact(keys=[self.key], args=[time()]), [0, 0])
+
+    def test_compact_sanctions_deletes_empty_set(self):
+        compact = self.db.register_script(COMPACT_SANCTIONS)
+        self.add(time() - 60)
+        self.assertEqual(compact(keys=[self.key], args=[time()]), [1, 2])
+        self.assertFalse(self.db.exists(self.key))
+        self.assertEqual(self.db.llen(self.key + ":history"), 1)
+
+    def test_compact_sanctions_keeps_epochs_numeric(self):
+        compact = self.db.register_script(COMPACT_SANCTIONS)
+        self.create(keys=[self.key], args=[1000, "expires", 1000, "issued", 900, "reason", "42"])
+        compact(keys=[self.key], args=[time()])
+        record = json.loads(self.db.lindex(self.key + ":history", 0))
+        self.assertEqual(record, {"id": 0, "lifted": False, "expires": 1000, "issued": 900, "reason": "42"})
+
+    def test_migrate_sanctions(self):
+        expires = round(time() + 60)
+        issued = round(time() - 60)
+        old = {"expires": strftime(TIME_FORMAT, localtime(expires)), "issued": strftime(TIME_FORMAT, localtime(issued))}
+        self.create(keys=[self.key], args=[expires, "expires", old["expires"], "issued", old["issued"], "reason", ""])
+        self.create(keys=[self.key], args=[expires, "expires", expires, "issued", issued, "reason", ""])
+        self.create(keys=[self.key], args=[expires, "expires", old["expires"], "issued", old["issued"], "reason", ""])
+        self.lift(keys=[self.key], args=[time()])
+
+        rewrite = self.db.register_script(MIGRATE_SANCTION)
+        self.assertEqual(migrate_sanctions(self.db, self.key, rewrite), 2)
+        for i in range(3):
+            self.assertEqual(self.db.hmget(self.key + ":{}".format(i), "expires", "issued"),
+                             [str(expires), str(issued)])
+        self.assertEqual(migrate_sanctions(self.db, self.key, rewrite), 0)
+
+    def test_migrate_sanction_skips_compacted(self):
+        rewrite = self.db.register_script(MIGRATE_SANCTION)
+        self.add(time() + 60)
+        self.assertEqual(rewrite(keys=[self.key + ":0"], args=["expires", 1000]), 1)
+        self.db.delete(self.key + ":0")
+        self.assertEqual(rewrite(keys=[self.key + ":0"], args=["expires", 1000]), 0)
+        self.assertFalse(self.db.exists(self.key + ":0"))
+
+    def test_migrate_history(self):
+        expires = round(time() - 60)
+        self.db.rpush(self.key + ":history",
+                      json.dumps({"id": 0, "expires": strftime(TIME_FORMAT, localtime(expires)), "reason": ""}),
+                      json.dumps({"id": 1, "expires": expires, "reason": ""}))
+
+        self.assertEqual(migrate_history(self.db, self.key + ":history"), 1)
+        self.assertEqual([json.loads(record)["expires"] for record in self.db.lrange(self.key + ":history", 0, -1)],
+                         [expires, expires])
+
+
+class TestEpochFields(unittest.TestCase):
+
+    def test_epochs_are_left_alone(self):
+        self.assertEqual(epoch_fields({"expires": "1000", "issued": "900.5"}, 1000), {})
+
+    def test_expiry_comes_from_score(self):
+        self.assertEqual(epoch_fields({"expires": "2016-03-27 02:30:00"}, 1459038600.0), {"expires": 1459038600})
+
+    def test_lifted_sanctions_parse_times(self):
+        expires = round(time())
+        issued = expires - 3600
+        sanction = {"expires": strftime(TIME_FORMAT, localtime(expires)),
+                    "issued": strftime(TIME_FORMAT, localtime(issued))}
+        self.assertEqual(epoch_fields(sanction), {"expires": expires, "issued": issued})
+
+    def test_unreadable_times_are_skipped(self):
+        self.assertEqual(epoch_fields({"expires": "never", "issued": None}), {})
@@ -0,0 +1,100 @@
+from minqlx_plugin_test import setup_plugin, setup_cvars, connected_players, unstub
+
+import unittest
+from unittest.mock import MagicMock
+
+from silence import silence
+
+from .sanction_plugin import SanctionPlugin
+
+from time import time
+
+STEAM_ID = 76561198000000001
+
+
+class TestSilence(unittest.TestCase):
+
+    def setUp(self):
+        setup_plugin()
+        setup_cvars({
+            "qlx_silenceCompactInterval": "24",
+        })
+        self.player = MagicMock(steam_id=STEAM_ID)
+        connected_players(self.player)
+        self.fixture = SanctionPlugin(silence)
+        self.db = self.fixture.db
+        self.plugin = self.fixture.plugin
+        self.plugin.feed.subscribed = True
+        self.sanctions = self.plugin.sanctions
+
+    def tearDown(self):
+        self.fixture.stop()
+        unstub()
+
+    def test_loading_player_is_muted_from_index(self):
+        self.plugin.index_silence(STEAM_ID, time() + 3600, "spam")
+        self.db.reset_mock()
+        self.sanctions.reset_mock()
+
+        self.plugin.handle_player_loaded(self.player)
+
+        self.player.mute.assert_called_once_with()
+        self.assertEqual(self.plugin.silenced[STEAM_ID][2], "spam")
+        self.assertEqual(self.db.mock_calls, [])
+        self.assertEqual(self.sanctions.mock_calls, [])
+
+    def test_expired_silences_in_index_are_ignored(self):
+        self.plugin.index_silence(STEAM_ID, time() - 1, "spam")
+        self.plugin.handle_player_loaded(self.player)
+
+        self.player.mute.assert_not_called()
+
+    def test_silence_while_loading_is_picked_up(self):
+        expires = int(time() + 3600)
+
+        # The silence arrives after the silences were read, but before the index is swapped in.
+        def all_longest():
+            self.plugin.index_silence(STEAM_ID, expires, "spam")
+            return iter(())
+
+        self.sanctions.all_longest.side_effect = all_longest
+        self.sanctions.longest.return_value = ("0", float(expires), {"reason": "spam"})
+        self.plugin.index_ready = False
+        self.plugin.load_index()
+
+        self.assertTrue(self.plugin.index_ready)
+        self.sanctions.longest.assert_called_once_with(STEAM_ID)
+        self.assertEqual(self.plugin.silences, {STEAM_ID: (expires, "spam")})
+
+    def test_silence_from_another_server_mutes_player(self):
+        expires = int(time() + 3600)
+        self.fixture.receive({"server": "other", "type": "silence", "steam_id": STEAM_ID, "expires": expires,
+                              "reason": "spam"})
+
+        self.player.mute.assert_called_once_with()
+        self.assertEqual(self.plugin.silenced[STEAM_ID][1:], (expires, "spam"))
+        self.assertEqual(self.plugin.silences, {STEAM_ID: (expires, "spam")})
+
+    def test_unsilence_from_another_server_unmutes_player(self):
+        self.fixture.receive({"server": "other", "type": "silence", "steam_id": STEAM_ID, "expires": time() + 3600,
+                              "reason": ""},
+                             {"server": "other", "type": "unsilence", "steam_id": STEAM_ID})
+
+        self.player.unmute.assert_called_once_with()
+        self.assertNotIn(STEAM_ID, self.plugin.silenced)
+        self.assertEqual(self.plugin.silences, {})
+
+    def test_silence_of_player_elsewhere_is_indexed(self):
+        self.fixture.receive({"server": "other", "type": "silence", "steam_id": STEAM_ID + 1, "expires": time() + 3600,
+                              "reason": ""})
+
+        self.player.mute.assert_not_called()
+        self.assertEqual(self.plugin.silenced, {})
+        self.assertIn(STEAM_ID + 1, self.plugin.silences)
+
+    def test_own_messages_are_skipped(self):
+        self.fixture.receive({"server": self.plugin.feed.server_id, "type": "silence", "steam_id": STEAM_ID,
+                              "expires": time() + 3600, "reason": ""})
+
+        self.player.mute.assert_not_called()
+        self.assertEqual(self.plugin.silences, {})